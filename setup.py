@@ -2,7 +2,7 @@ from setuptools import setup
 
 setup(
     name='flbenchmark',
-    version='0.1.3',
+    version='0.2.0',
     description='flbenchmark',
     author='stneng',
     author_email='git@stneng.com',
@@ -15,5 +15,8 @@ setup(
         'scipy',
         'Pillow',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     python_requires='>=3.6',
 )
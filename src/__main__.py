@@ -58,15 +58,28 @@ def start(config_file):
         tmp_file = config_file+'.tmp'
         os.remove(tmp_file)
 
+    schedule_file = os.path.join(working_dir, str(id), 'schedule.npy')
+    raw_schedule_file = os.path.join(raw_working_dir, str(id), 'schedule.npy')
+    has_schedule = False
     if config['bench_param']['mode'] == 'local':
         prepare_dataset(config['dataset'])
         prepare_framework_image(config['framework'])
+        has_schedule = prepare_schedule(config, data_dir, schedule_file)
     elif config['bench_param']['mode'] == 'remote':
         for host in config['bench_param']['hosts']:
             remote_bash_cmd = 'python3 -m flbenchmark prepare_dataset {}'.format(config['dataset'])
             remote_run(host['hostname'], remote_bash_cmd)
             remote_bash_cmd = 'python3 -m flbenchmark prepare_framework_image {}'.format(config['framework'])
             remote_run(host['hostname'], remote_bash_cmd)
+        if schedule_param(config) is not None:
+            # sampled once on the first host, which has the dataset now, and pushed to every host like config.json
+            first_host = config['bench_param']['hosts'][0]['hostname']
+            remote_bash_cmd = 'python3 -m flbenchmark prepare_schedule {}'.format(raw_config_file)
+            remote_run(first_host, remote_bash_cmd)
+            remote_pull(first_host, raw_schedule_file, schedule_file)
+            for host in config['bench_param']['hosts']:
+                remote_push(host['hostname'], schedule_file, raw_schedule_file)
+            has_schedule = True
 
     docker_cmd = 'docker run -dit --rm '
     debug_flag = os.environ.get('FLB_DEBUG', 'false').lower() == 'true'
@@ -82,6 +95,10 @@ def start(config_file):
         if config['bench_param']['device'] == 'gpu':
             docker_cmd += '--gpus \'"device={},{}"\' '.format(group_id*2, group_id*2+1)
         print(docker_cmd)
+    if has_schedule:
+        # next to config.json, which fedml and fedscale read from their own directory
+        schedule_dir = {'fedml': '/FedML', 'fedscale': '/FedScale'}.get(config['framework'], '/test')
+        docker_cmd += '-v {}:{}/schedule.npy '.format(raw_schedule_file, schedule_dir)
 
     if config['framework'] == 'crypten':
         if config['bench_param']['mode'] == 'local':
@@ -273,7 +290,9 @@ def prepare_dataset(dataset_name):
                      'motor_vertical', 'breast_vertical', 'default_credit_vertical', 'dvisits_vertical', 'give_credit_vertical', 'student_vertical', 'vehicle_scale_vertical']
     LEAF_DATASETS = ['celeba', 'femnist', 'reddit', 'sent140', 'shakespeare', 'synthetic']
     raw_data_dir = '~/flbenchmark.working/data'
-    flbd = flbenchmark.datasets.FLBDatasets(raw_data_dir)
+    # the cache is mounted into the framework images, which install the released flbenchmark; json is the format every
+    # version of it can read, switch to columnar once the images install a version that reads columnar caches
+    flbd = flbenchmark.datasets.FLBDatasets(raw_data_dir, format='json')
 
     if dataset_name in FATE_DATASETS:
         dataset = flbd.fateDatasets(dataset_name)
@@ -288,6 +307,29 @@ def prepare_dataset(dataset_name):
         raise RuntimeError('Failed when preparing dataset {}. Please check the error message.'.format(dataset_name))
 
 
+def schedule_param(config):
+    # (rounds, clients_per_round) if the config asks for a client schedule, None otherwise
+    training_param = config.get('training_param', {})
+    clients_per_round = training_param.get('client_per_round', training_param.get('num_clients_per_iteration'))
+    if clients_per_round is None or 'epochs' not in training_param:
+        return None
+    return training_param['epochs'], clients_per_round
+
+
+def prepare_schedule(config, data_dir, schedule_file):
+    # the clients of every round are sampled once here and mounted next to config.json, so all frameworks run the same workload
+    param = schedule_param(config)
+    train_dir = os.path.join(data_dir, config['dataset'], 'train')
+    if param is None or not os.path.exists(os.path.join(train_dir, '_main.json')):
+        return False
+    training_param = config['training_param']
+    schedule = flbenchmark.datasets.dataset_schedule(train_dir, param[0], param[1],
+                                                     seed=training_param.get('schedule_seed', 0),
+                                                     weighted=training_param.get('schedule_weighted', False))
+    flbenchmark.datasets.save_schedule(schedule_file, schedule)
+    return True
+
+
 def prepare_framework_image(framework_name):
     if framework_name.startswith('custom:'):
         return
@@ -331,6 +373,13 @@ if __name__ == '__main__':
         if sys.argv[1] == 'prepare_dataset':
             prepare_dataset(sys.argv[2])
             exit(0)
+        elif sys.argv[1] == 'prepare_schedule':
+            # run on a remote host, writes schedule.npy next to the config pushed there
+            schedule_config_file = os.path.expanduser(sys.argv[2])
+            if not prepare_schedule(json.load(open(schedule_config_file, 'r')), os.path.expanduser('~/flbenchmark.working/data'),
+                                    os.path.join(os.path.dirname(schedule_config_file), 'schedule.npy')):
+                raise RuntimeError('Failed when preparing the schedule of {}. Please check the config.'.format(sys.argv[2]))
+            exit(0)
         elif sys.argv[1] == 'prepare_framework_image':
             prepare_framework_image(sys.argv[2])
             exit(0)
@@ -1,2 +1,6 @@
 from .flbdatasets import FLBDatasets
+from .storage import load_dataset, save_dataset, check_cache, open_party, save_splits
+from .shared import publish_dataset, attach_dataset
+from .schedule import client_schedule, dataset_schedule, save_schedule, load_schedule
 from .utils import convert_to_csv
+from .images import decode_images, image_tensor
@@ -0,0 +1,108 @@
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from .storage import read_manifest
+
+VARIANTS_DIR = '_variants'
+COMPLETE_MARKER = '_complete.json'
+
+
+@contextmanager
+def cache_lock(path):
+    # exclusive lock on <path>.lock, concurrent preparations of the same cache wait here instead of racing
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path+'.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def is_complete(path):
+    # a cache is complete if it has the marker and every split still has the fingerprint recorded in it
+    try:
+        with open(os.path.join(path, COMPLETE_MARKER), 'r') as infile:
+            fingerprints = json.load(infile)['fingerprints']
+        return all(read_manifest(os.path.join(path, split)).get('fingerprint') == fingerprint for split, fingerprint in fingerprints.items())
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+
+def mark_complete(path, splits):
+    # the marker is written last and records the fingerprint of every split, see check_cache
+    fingerprints = {split: read_manifest(os.path.join(path, split)).get('fingerprint') for split in splits}
+    with open(os.path.join(path, COMPLETE_MARKER), 'w') as outfile:
+        outfile.write(json.dumps({'fingerprints': fingerprints}, indent=4))
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+
+def staging_dir(path):
+    # must be called with cache_lock(path) held, leftovers of crashed preparations are removed first
+    parent, name = os.path.split(os.path.abspath(path))
+    for entry in os.listdir(parent):
+        if entry.startswith(name+'.tmp-') and os.path.isdir(os.path.join(parent, entry)):
+            shutil.rmtree(os.path.join(parent, entry))
+    return tempfile.mkdtemp(prefix=name+'.tmp-', dir=parent)
+
+
+def commit_staging(staging, path, splits):
+    # a cache only appears under its final name once it is complete
+    mark_complete(staging, splits)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(staging, path)
+
+
+def variant_key(*parts):
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def variant_dir(root, dataset, key):
+    return os.path.join(root, VARIANTS_DIR, dataset+'-'+key)
+
+
+def activate_variant(root, dataset, path):
+    # root/<dataset> is a relative symlink to the active variant, so <root>/<dataset>/train also resolves inside containers
+    link = os.path.join(root, dataset)
+    tmp_link = link+'.tmp-'+str(os.getpid())
+    os.symlink(os.path.relpath(path, root), tmp_link)
+    os.replace(tmp_link, link)
+    # the mtime of a variant is its last use, see evict_variants
+    os.utime(path)
+
+
+def dir_size(path):
+    size = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            size += os.path.getsize(os.path.join(dir_path, file_name))
+    return size
+
+
+def evict_variants(root, max_bytes):
+    # removes the least recently used variants until all of them fit in max_bytes, active variants are never removed
+    variants_root = os.path.join(root, VARIANTS_DIR)
+    if not os.path.exists(variants_root):
+        return
+    active = set(os.path.realpath(os.path.join(root, name)) for name in os.listdir(root) if os.path.islink(os.path.join(root, name)))
+    variants = [os.path.join(variants_root, name) for name in os.listdir(variants_root)]
+    variants = [path for path in variants if os.path.isdir(path) and is_complete(path)]
+    variants.sort(key=os.path.getmtime)
+    sizes = {path: dir_size(path) for path in variants}
+    total = sum(sizes.values())
+    for path in variants:
+        if total <= max_bytes:
+            break
+        if os.path.realpath(path) in active:
+            continue
+        with cache_lock(path):
+            # another launch evicting at the same time may have removed it while this one waited for the lock
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        total -= sizes[path]
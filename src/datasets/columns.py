@@ -0,0 +1,327 @@
+import json
+import base64
+import numpy as np
+
+NUMERIC_DTYPES = ['bool', 'int8', 'int16', 'int32', 'int64', 'float32', 'float64']
+VAR_DTYPES = ['str', 'json', 'image']
+
+
+class VarColumn:
+    # variable-length column: values are stored back to back in `data` (uint8) and value i is data[offsets[i]:offsets[i+1]]
+    def __init__(self,
+                 dtype: str,  # str / json / image (the encoded bytes of an image file, base64 text as a value)
+                 data: np.ndarray,
+                 offsets: np.ndarray,
+                 ):
+        self.dtype = dtype
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise IndexError('VarColumn only supports contiguous slices.')
+            return VarColumn(self.dtype, self.data, self.offsets[start:max(start, stop)+1])
+        return self.decode(self.raw(i))
+
+    def raw(self, i):
+        # the stored bytes of value i, e.g. the jpeg file of an image column
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('VarColumn index out of range')
+        return self.data[self.offsets[i]:self.offsets[i+1]].tobytes()
+
+    def take(self, indices):
+        # gathers the values at indices into a new packed column without decoding them
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = np.where(indices < 0, indices+len(self), indices)
+        if len(indices) > 0 and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError('VarColumn index out of range')
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices+1]-starts
+        offsets = np.zeros(len(indices)+1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.repeat(starts-offsets[:-1], lengths)+np.arange(offsets[-1])
+        return VarColumn(self.dtype, np.asarray(self.data[positions]), offsets)
+
+    def decode(self, raw):
+        if self.dtype == 'str':
+            return raw.decode('utf-8')
+        if self.dtype == 'image':
+            return base64.b64encode(raw).decode('utf-8')
+        return json.loads(raw)
+
+    def tolist(self):
+        buf = self.data[self.offsets[0]:self.offsets[-1]].tobytes()
+        offsets = (self.offsets-self.offsets[0]).tolist()
+        if self.dtype == 'str':
+            return [buf[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(len(offsets)-1)]
+        if self.dtype == 'image':
+            return [base64.b64encode(buf[offsets[i]:offsets[i+1]]).decode('utf-8') for i in range(len(offsets)-1)]
+        # one json.loads over the whole column instead of one call per value
+        return json.loads(b'['+b','.join(buf[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1))+b']')
+
+
+class RecordView:
+    # read-only List[List] over the columns of a party, rows are only built when they are accessed
+    def __init__(self, columns, chunk_size=4096):
+        self.columns = columns
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.columns[0]) if len(self.columns) > 0 else 0
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            return RecordView([column[start:stop] for column in self.columns], self.chunk_size)
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('record index out of range')
+        return [column[i:i+1].tolist()[0] for column in self.columns]
+
+    def __iter__(self):
+        for start in range(0, len(self), self.chunk_size):
+            yield from columns_to_records([column[start:start+self.chunk_size] for column in self.columns])
+
+    def __eq__(self, other):
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+
+def downcast(array):
+    # the smallest dtype that holds every value of a numeric array exactly, ints never become floats
+    if array.dtype.kind == 'i' and len(array) > 0:
+        low, high = array.min(), array.max()
+        for dtype in [np.int8, np.int16, np.int32]:
+            if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+                return array.astype(dtype)
+    elif array.dtype == np.float64:
+        with np.errstate(over='ignore', invalid='ignore'):
+            narrowed = array.astype(np.float32)
+        widened = narrowed.astype(np.float64)
+        if np.all((widened == array) | (np.isnan(widened) & np.isnan(array))):
+            return narrowed
+    return array
+
+
+def infer_dtype(values):
+    types = set(map(type, values))
+    if len(types) == 0:
+        return 'json'
+    if all(issubclass(t, (bool, np.bool_)) for t in types):
+        return 'bool'
+    if all(issubclass(t, (int, np.integer)) and not issubclass(t, (bool, np.bool_)) for t in types):
+        try:
+            return downcast(np.array(values, dtype=np.int64)).dtype.name
+        except OverflowError:
+            return 'json'
+    if all(issubclass(t, (float, np.floating)) for t in types):
+        return downcast(np.array(values, dtype=np.float64)).dtype.name
+    if types == {str}:
+        return 'str'
+    return 'json'
+
+
+def encode_column(values, dtype):
+    if dtype in NUMERIC_DTYPES:
+        return np.array(values, dtype=dtype)
+    if dtype == 'str':
+        encoded = [value.encode('utf-8') for value in values]
+    elif dtype == 'image':
+        encoded = list(values)
+    else:
+        encoded = [json.dumps(value).encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)), out=offsets[1:])
+    return VarColumn(dtype, np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+
+def select_rows(column, rows):
+    # rows: None, a slice / range with step 1 (a view, nothing is read) or anything usable as an index array
+    if rows is None:
+        return column
+    if isinstance(rows, range):
+        # a range only means the same as the slice with its bounds for step 1 over non-negative rows
+        rows = slice(rows.start, rows.stop) if rows.step == 1 and rows.start >= 0 else np.arange(rows.start, rows.stop, rows.step)
+    if isinstance(rows, slice) and rows.step in [None, 1]:
+        return column[rows]
+    if isinstance(rows, slice):
+        rows = range(*rows.indices(len(column)))
+    if isinstance(column, VarColumn):
+        return column.take(rows)
+    return column[np.asarray(rows, dtype=np.int64)]
+
+
+def concat_columns(columns):
+    # the rows of several columns one after another, e.g. one column of every party
+    dtypes = set(column.dtype if isinstance(column, VarColumn) else 'numeric' for column in columns)
+    if len(dtypes) > 1:
+        values = [value for column in columns for value in column.tolist()]
+        return encode_column(values, infer_dtype(values))
+    if isinstance(columns[0], VarColumn):
+        lengths = [column.offsets[-1]-column.offsets[0] for column in columns]
+        shifts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        offsets = np.concatenate([[0]]+[column.offsets[1:]-column.offsets[0]+shift for column, shift in zip(columns, shifts)])
+        data = np.concatenate([column.data[column.offsets[0]:column.offsets[-1]] for column in columns])
+        return VarColumn(columns[0].dtype, data, offsets.astype(np.int64))
+    return np.concatenate(columns)
+
+
+def stack_columns(columns, rows=None):
+    # the given rows of several columns as one contiguous 2-d array, object dtype if any column is not numeric
+    columns = [select_rows(column, rows) for column in columns]
+    if any(isinstance(column, VarColumn) for column in columns):
+        array = np.empty((len(columns[0]) if len(columns) > 0 else 0, len(columns)), dtype=object)
+        for t, column in enumerate(columns):
+            array[:, t] = column.tolist()
+        return array
+    array = np.empty((len(columns[0]) if len(columns) > 0 else 0, len(columns)),
+                     dtype=np.result_type(*[column.dtype for column in columns]) if len(columns) > 0 else np.float64)
+    for t, column in enumerate(columns):
+        array[:, t] = column
+    return array
+
+
+def block_view(columns):
+    # the 2-d array the columns were sliced from, if they are consecutive columns of one fortran-ordered block (see storage.py)
+    if len(columns) == 0 or not all(isinstance(column, np.ndarray) for column in columns):
+        return None
+    base = columns[0].base
+    if not isinstance(base, np.ndarray) or base.ndim != 2 or not base.flags.f_contiguous or len(columns[0]) != base.shape[0]:
+        return None
+    pointer = base.__array_interface__['data'][0]
+    column_bytes = base.shape[0]*base.itemsize
+    first = (columns[0].__array_interface__['data'][0]-pointer)//column_bytes if column_bytes > 0 else 0
+    for t, column in enumerate(columns):
+        if column.base is not base or column.dtype != base.dtype or column.strides != (base.itemsize,) or \
+                column.__array_interface__['data'][0] != pointer+(first+t)*column_bytes:
+            return None
+    return base[:, first:first+len(columns)]
+
+
+def to_matrix(columns):
+    # a view of the storage when the columns form one block, a contiguous copy otherwise
+    view = block_view(columns)
+    if view is not None:
+        return view
+    return stack_columns(columns)
+
+
+def column_stats(columns):
+    # (len(columns), 4) array of min, max, mean over the values that are not missing and the number of missing values
+    # (NaN, json null) of every column, numeric columns are reduced together; min / max / mean are NaN for str / json columns
+    stats = np.full((len(columns), 4), np.nan)
+    stats[:, 3] = 0
+    numeric = [j for j, column in enumerate(columns) if not isinstance(column, VarColumn)]
+    if len(numeric) > 0:
+        matrix = stack_columns([columns[j] for j in numeric]).astype(np.float64, copy=False)
+        present = ~np.isnan(matrix)
+        count = present.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stats[numeric, 0] = np.where(count > 0, np.where(present, matrix, np.inf).min(axis=0, initial=np.inf), np.nan)
+            stats[numeric, 1] = np.where(count > 0, np.where(present, matrix, -np.inf).max(axis=0, initial=-np.inf), np.nan)
+            stats[numeric, 2] = np.where(count > 0, np.where(present, matrix, 0).sum(axis=0)/count, np.nan)
+        stats[numeric, 3] = len(matrix)-count
+    for j, column in enumerate(columns):
+        if isinstance(column, VarColumn) and column.dtype == 'json':
+            lengths = np.diff(column.offsets)
+            starts = np.asarray(column.offsets[:-1][lengths == 4], dtype=np.int64)
+            if len(starts) > 0:
+                text = np.asarray(column.data)[starts[:, None]+np.arange(4)]
+                stats[j, 3] = np.all(text == np.frombuffer(b'null', dtype=np.uint8), axis=1).sum()
+    return stats
+
+
+def value_counts(column):
+    # {value: count} with the values as text (json text unless the column is str), so that it can be stored in _main.json
+    if isinstance(column, VarColumn):
+        counts = {}
+        data = column.data[column.offsets[0]:column.offsets[-1]].tobytes()
+        offsets = (column.offsets-column.offsets[0]).tolist()
+        for i in range(len(offsets)-1):
+            value = data[offsets[i]:offsets[i+1]]
+            value = column.decode(value) if column.dtype == 'image' else value.decode('utf-8')
+            counts[value] = counts.get(value, 0)+1
+        return counts
+    values, counts = np.unique(np.asarray(column), return_counts=True)
+    return {json.dumps(value): count for value, count in zip(values.tolist(), counts.tolist())}
+
+
+def unify_floats(columns):
+    # float columns are only kept as float32 if all of them are, so that they are stored as one block (see
+    # storage.column_blocks) instead of alternating float32 / float64 runs; widening float32 back is exact
+    if any(isinstance(column, np.ndarray) and column.dtype == np.float64 for column in columns):
+        columns = [column.astype(np.float64) if isinstance(column, np.ndarray) and column.dtype == np.float32 else column
+                   for column in columns]
+    return columns
+
+
+def columns_from_pandas(df):
+    # one column per DataFrame column, converted from the column's numpy array in bulk; numeric columns get the same
+    # dtypes as records_to_columns would give their values, other columns go through python values
+    columns = []
+    for j in range(df.shape[1]):
+        series = df.iloc[:, j]
+        kind = series.dtype.kind if isinstance(series.dtype, np.dtype) else None
+        if kind == 'b':
+            columns.append(series.to_numpy(dtype=np.bool_))
+        elif kind in ['i', 'u'] and (kind == 'i' or len(series) == 0 or series.max() <= np.iinfo(np.int64).max):
+            columns.append(downcast(series.to_numpy(dtype=np.int64)))
+        elif kind == 'f':
+            columns.append(downcast(series.to_numpy(dtype=np.float64)))
+        else:
+            values = series.astype(object).where(series.notna(), None).tolist()
+            columns.append(encode_column(values, infer_dtype(values)))
+    return unify_floats(columns)
+
+
+def downcast_rows(block):
+    # downcast applied to every row of a 2-d int64 / float64 array at once
+    if block.dtype == np.float64:
+        with np.errstate(over='ignore', invalid='ignore'):
+            narrowed = block.astype(np.float32)
+        widened = narrowed.astype(np.float64)
+        lossless = np.all((widened == block) | (np.isnan(widened) & np.isnan(block)), axis=1)
+        return [narrowed[i] if lossless[i] else block[i] for i in range(len(block))]
+    low, high = block.min(axis=1), block.max(axis=1)
+    rows = [block[i] for i in range(len(block))]
+    for dtype in [np.int32, np.int16, np.int8]:
+        fits = (np.iinfo(dtype).min <= low) & (high <= np.iinfo(dtype).max)
+        rows = [row.astype(dtype) if fit else row for row, fit in zip(rows, fits)]
+    return rows
+
+
+def records_to_columns(records, num_columns):
+    values = [[record[j] for record in records] for j in range(num_columns)]
+    columns = [None]*num_columns
+    # columns of plain python floats or ints (e.g. the pixels of femnist) are converted together, which gives the same
+    # arrays as infer_dtype / encode_column one column at a time
+    types = [set(map(type, column_values)) for column_values in values]
+    for kind, dtype in [(float, np.float64), (int, np.int64)]:
+        indices = [j for j in range(num_columns) if types[j] == {kind}]
+        if len(indices) == 0:
+            continue
+        try:
+            block = np.array([values[j] for j in indices], dtype=dtype)
+        except OverflowError:
+            continue
+        for j, column in zip(indices, downcast_rows(block)):
+            columns[j] = column
+    for j in range(num_columns):
+        if columns[j] is None:
+            columns[j] = encode_column(values[j], infer_dtype(values[j]))
+    return unify_floats(columns)
+
+
+def columns_to_records(columns):
+    if len(columns) == 0:
+        return []
+    return list(map(list, zip(*[column.tolist() for column in columns])))
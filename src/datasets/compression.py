@@ -0,0 +1,48 @@
+import gzip
+import struct
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = ['gzip', 'zstd']
+CHUNK_SIZE = 1 << 22
+
+
+def get_codec(codec):
+    if codec == 'gzip':
+        return lambda data: gzip.compress(data, compresslevel=6), gzip.decompress
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError('the zstd codec requires the zstandard package, please run `pip install zstandard`.')
+        return zstandard.ZstdCompressor(level=3).compress, lambda data: zstandard.ZstdDecompressor().decompress(data)
+    raise NotImplementedError('Codec {} is not supported.'.format(codec))
+
+
+def write_compressed(path, data, codec, chunk_size=CHUNK_SIZE):
+    # the file is a sequence of independently compressed chunks, each prefixed with its compressed length
+    compress, _ = get_codec(codec)
+    data = memoryview(data).cast('B')
+    with open(path, 'wb') as outfile:
+        for start in range(0, len(data), chunk_size):
+            chunk = compress(data[start:start+chunk_size])
+            outfile.write(struct.pack('<Q', len(chunk)))
+            outfile.write(chunk)
+
+
+def read_compressed(path, codec, threads=None):
+    # chunks are decompressed in parallel threads, zlib and zstd release the GIL while decompressing
+    _, decompress = get_codec(codec)
+    with open(path, 'rb') as infile:
+        raw = infile.read()
+    chunks = []
+    position = 0
+    while position < len(raw):
+        length, = struct.unpack_from('<Q', raw, position)
+        chunks.append(raw[position+8:position+8+length])
+        position += 8+length
+    if len(chunks) <= 1:
+        return b''.join(map(decompress, chunks))
+    with ThreadPoolExecutor(threads) as pool:
+        return b''.join(pool.map(decompress, chunks))
@@ -1,21 +1,335 @@
+import io
 import json
 import os
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from typing import List
+import numpy as np
+from .columns import VarColumn, RecordView, records_to_columns, columns_to_records, select_rows, stack_columns, block_view, to_matrix, \
+    column_stats, value_counts
+
+
+def pool_map(fn, *iterables, workers=None, chunksize=1):
+    # ordered map over a process pool, or a plain map when workers is None or 1
+    if workers is None or workers <= 1:
+        return list(map(fn, *iterables))
+    with ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(fn, *iterables, chunksize=chunksize))
+
+
+def prefetch(generator, size=1):
+    # runs generator in a background thread, keeping up to size items ready ahead of the consumer
+    items = queue.Queue(size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # gives up once the consumer has stopped, so the thread never blocks on a queue nobody reads
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in generator:
+                if not put(item):
+                    return
+            put(done)
+        except BaseException as e:
+            put(e)
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+class JsonRecords:
+    # read-only List[List] over a party json file and its offset index, every record is one seek and one json.loads
+    def __init__(self, path, index):
+        self.path = path
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.take(range(*i.indices(len(self))))
+        start, end = self.index[i]
+        with open(self.path, 'rb') as infile:
+            infile.seek(start)
+            return json.loads(infile.read(end-start))
+
+    def take(self, indices):
+        records = []
+        with open(self.path, 'rb') as infile:
+            for start, end in self.index[np.asarray(indices, dtype=np.int64)].tolist():
+                infile.seek(start)
+                records.append(json.loads(infile.read(end-start)))
+        return records
+
+    def __iter__(self):
+        for start in range(0, len(self), 4096):
+            yield from self.take(range(start, min(start+4096, len(self))))
 
 
 class Party:
     def __init__(self,
                  name: str,
                  column_name: List[str],
-                 records: List[List],  # List[List[str/int/list]]
+                 records: List[List] = None,  # List[List[str/int/list]]
                  # FIXME group_id? hierarchies are dropped by leaf in split_data.py, unknown reasons
+                 columns: List = None,  # one array per column (see columns.py), used instead of records when given
                  ):
         self.name = name
         self.column_name = column_name
-        self.records = records
+        self._records = records
+        self.columns = columns
 
-    def to_json(self):
-        return json.dumps(self, indent=4, default=lambda x: x.__dict__)
+    @property
+    def records(self):
+        # parties loaded from a columnar cache are backed by memory-mapped columns and only build rows on access
+        if self._records is None and self.columns is not None:
+            return RecordView(self.columns)
+        return self._records
+
+    @records.setter
+    def records(self, records):
+        if isinstance(records, RecordView):
+            self._records = None
+            self.columns = records.columns
+        else:
+            self._records = records
+            self.columns = None
+
+    def to_columns(self):
+        if self.columns is not None:
+            return self.columns
+        records = self._records if isinstance(self._records, list) else list(self._records)
+        return records_to_columns(records, len(self.column_name))
+
+    def select(self, columns=None, rows=None):
+        # a party with only the named columns (in the given order, names the party does not have are skipped)
+        # and only the given rows (slice, range or index array); columnar parties do this without copying slices
+        if columns is None:
+            indices = list(range(len(self.column_name)))
+        else:
+            indices = [self.column_name.index(name) for name in columns if name in self.column_name]
+        column_name = [self.column_name[j] for j in indices]
+        if self.columns is not None:
+            return Party(self.name, column_name, columns=[select_rows(self.columns[j], rows) for j in indices])
+        records = self._records
+        if isinstance(rows, range) and not (rows.step == 1 and rows.start >= 0):
+            rows = list(rows)
+        if isinstance(rows, (slice, range)):
+            records = records[slice(rows.start, rows.stop, rows.step)]
+        elif rows is not None:
+            records = [records[i] for i in rows]
+        if columns is not None:
+            records = [[record[j] for j in indices] for record in records]
+        return Party(self.name, column_name, records)
+
+    def to_dict(self):
+        # the fields of the party with its records as a list, whatever storage they come from
+        return {'name': self.name, 'column_name': self.column_name, 'records': list(self.records)}
+
+    def to_json(self, indent=4):
+        outfile = io.StringIO()
+        self.dump_json(outfile, indent)
+        return outfile.getvalue()
+
+    def dump_json(self, outfile, indent=4, chunk_size=1 << 20):
+        # writes the same text as json.dumps(party, indent=indent) record by record, flushing every chunk_size characters,
+        # so the whole document never has to be held in memory; indent=None writes compact json.
+        # returns the [start, end) byte offsets of every record in the file, see JsonRecords
+        if indent is None:
+            separators, newline, pad = (',', ':'), '', ''
+        else:
+            separators, newline, pad = (',', ': '), '\n', ' '*indent
+
+        def encode(value, level):
+            return json.dumps(value, indent=indent, separators=separators).replace('\n', '\n'+pad*level)
+
+        buffer = ['{', newline, pad, '"name"', separators[1], encode(self.name, 1), separators[0],
+                  newline, pad, '"column_name"', separators[1], encode(self.column_name, 1), separators[0],
+                  newline, pad, '"records"', separators[1]]
+        # json.dumps escapes non-ascii characters, so character positions are byte offsets
+        position = sum(map(len, buffer))
+        index = []
+        buffer_size = 0
+        first = True
+        for record in self.records:
+            prefix = ('[' if first else separators[0])+newline+pad*2
+            text = encode(record, 2)
+            buffer.append(prefix)
+            buffer.append(text)
+            index.append((position+len(prefix), position+len(prefix)+len(text)))
+            position += len(prefix)+len(text)
+            buffer_size += len(text)
+            first = False
+            if buffer_size >= chunk_size:
+                outfile.write(''.join(buffer))
+                buffer = []
+                buffer_size = 0
+        buffer.append('[]' if first else newline+pad+']')
+        buffer.append(newline+'}')
+        outfile.write(''.join(buffer))
+        return np.array(index, dtype=np.int64).reshape(-1, 2)
+
+    def get_record(self, i):
+        return self.records[i]
+
+    def get_records(self, indices):
+        # the records at indices in one call, reading only those rows for columnar and indexed json parties
+        if self.columns is not None:
+            return columns_to_records([select_rows(column, indices) for column in self.columns])
+        if isinstance(self._records, JsonRecords):
+            return self._records.take(indices)
+        return [self._records[i] for i in indices]
+
+    def to_numpy(self, label_name=None):
+        # all columns as one 2-d array, or (features, labels) when label_name is given; for a columnar party whose
+        # columns share one dtype this is a read-only view of the memory-mapped block, otherwise a copy
+        columns = self.to_columns()
+        if label_name not in self.column_name:
+            return to_matrix(columns)
+        label_index = self.column_name.index(label_name)
+        features = to_matrix([column for j, column in enumerate(columns) if j != label_index])
+        labels = columns[label_index]
+        if isinstance(labels, VarColumn):
+            labels = np.array(labels.tolist(), dtype=object)
+        return features, labels
+
+    def to_pandas(self):
+        # a DataFrame over the party's columns, numeric columns are not copied
+        import pandas as pd
+        columns = self.to_columns()
+        view = block_view(columns)
+        if view is not None:
+            return pd.DataFrame(view, columns=self.column_name, copy=False)
+        data = {}
+        for name, column in zip(self.column_name, columns):
+            data[name] = np.array(column.tolist(), dtype=object) if isinstance(column, VarColumn) else column
+        return pd.DataFrame(data, columns=self.column_name, copy=False)
+
+    def stats(self, label_name=None):
+        # row count, label histogram and per-column min / max / mean / missing counts (arrays in the order of column_name)
+        columns = self.to_columns()
+        stats = column_stats(columns)
+        return {
+            'num_records': len(self.records),
+            'label_counts': value_counts(columns[self.column_name.index(label_name)]) if label_name in self.column_name else None,
+            'missing': int(stats[:, 3].sum()),
+            'min': stats[:, 0],
+            'max': stats[:, 1],
+            'mean': stats[:, 2],
+            'column_missing': stats[:, 3].astype(np.int64),
+        }
+
+    def split(self, fractions=None, seed=None, label_name=None):
+        # see split.py
+        from .split import split_party
+        return split_party(self, fractions, seed, label_name)
+
+    def iter_batches(self, batch_size, shuffle=False, seed=None, drop_last=False, label_name=None, prefetch_batches=1):
+        # yields (features, labels) as contiguous numpy arrays, labels is the label_name column (None if the party has none)
+        # and features are all other columns; the next batches are gathered in a background thread while one is consumed
+        columns = self.to_columns()
+        label_index = self.column_name.index(label_name) if label_name in self.column_name else None
+        feature_columns = [column for j, column in enumerate(columns) if j != label_index]
+        num_records = len(self.records)
+        order = np.random.default_rng(seed).permutation(num_records) if shuffle else None
+
+        def batches():
+            stop = num_records-num_records % batch_size if drop_last else num_records
+            for start in range(0, stop, batch_size):
+                rows = slice(start, min(start+batch_size, num_records)) if order is None else order[start:start+batch_size]
+                features = stack_columns(feature_columns, rows)
+                if label_index is None:
+                    yield features, None
+                else:
+                    yield features, stack_columns([columns[label_index]], rows)[:, 0]
+        if prefetch_batches > 0:
+            return prefetch(batches(), prefetch_batches)
+        return batches()
+
+
+class LazyParties:
+    # List[Party] that loads each party the first time it is accessed and keeps at most max_resident of them (LRU)
+    def __init__(self, names, loader, max_resident=None):
+        self.names = names
+        self.loader = loader
+        self.max_resident = max_resident
+        self.resident = OrderedDict()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        name = self.names[i]
+        if name in self.resident:
+            self.resident.move_to_end(name)
+            return self.resident[name]
+        party = self.loader(name)
+        self.resident[name] = party
+        if self.max_resident is not None:
+            while len(self.resident) > self.max_resident:
+                self.resident.popitem(last=False)
+        return party
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def index(self, name):
+        return self.names.index(name)
+
+
+def id_array(column):
+    if isinstance(column, VarColumn):
+        return np.array(column.tolist(), dtype=object)
+    return np.asarray(column)
+
+
+def unique_index(ids):
+    # a hash index over ids and the row of every entry, the first row wins for duplicated ids
+    import pandas as pd
+    index = pd.Index(ids)
+    if index.is_unique:
+        return index, np.arange(len(ids))
+    rows = np.flatnonzero(~index.duplicated())
+    return index[rows], rows
+
+
+def align_ids(ids):
+    # one hash lookup of the ids of the first party in the index of every other party, no pairwise comparisons
+    index, rows = unique_index(ids[0])
+    keys = index.to_numpy()
+    found = np.ones(len(keys), dtype=bool)
+    matches = [rows]
+    for party_ids in ids[1:]:
+        party_index, party_rows = unique_index(party_ids)
+        indexer = party_index.get_indexer(keys)
+        found &= indexer >= 0
+        matches.append(party_rows[indexer])
+    return [matched[found].astype(np.int64) for matched in matches], int(found.sum())
 
 
 class Dataset:
@@ -25,36 +339,123 @@ class Dataset:
                  label_name: str,
                  parties: List[Party],  # convert to List[party.name] before save to json file
                  options: dict = None,  # options
+                 stats: dict = None,  # {party.name: Party.stats}, read from the cache or computed on first access
+                 alignment: tuple = None,  # see align, read from the cache or computed on first access
                  ):
         self.name = name
         self.type = type
         self.label_name = label_name
         self.parties = parties
         self.options = options
+        self._stats = stats
+        self._alignment = alignment
+
+    @property
+    def stats(self):
+        if self._stats is None:
+            self._stats = {party.name: party.stats(self.label_name) for party in self.parties}
+        return self._stats
+
+    def align(self):
+        # (rows, size): rows[i] are the rows of party i whose unique_id is in every party, ordered so that rows[i][k] of
+        # all parties carry the same id (in the order of the first party), size is the size of the intersection
+        if self._alignment is None:
+            unique_id = (self.options or {}).get('unique_id')
+            if unique_id is None:
+                raise RuntimeError('the dataset {} has no unique_id to align its parties by.'.format(self.name))
+            ids = []
+            for party in self.parties:
+                if unique_id not in party.column_name:
+                    raise RuntimeError('the party {} has no {} column.'.format(party.name, unique_id))
+                ids.append(id_array(party.to_columns()[party.column_name.index(unique_id)]))
+            self._alignment = align_ids(ids)
+        return self._alignment
+
+    def party_names(self):
+        if isinstance(self.parties, LazyParties):
+            return list(self.parties.names)
+        # parties can also be given by name only, e.g. FATE_DATASETS or a dataset written party by party
+        return [party if isinstance(party, str) else party.name for party in self.parties]
+
+    def get_party(self, name):
+        return self.parties[self.party_names().index(name)]
+
+    def to_numpy(self, party_name):
+        # Party.to_numpy split by the label column of this dataset
+        return self.get_party(party_name).to_numpy(self.label_name)
+
+    def iter_batches(self, party_name, batch_size, **kwargs):
+        # Party.iter_batches with the label column of this dataset
+        return self.get_party(party_name).iter_batches(batch_size, label_name=self.label_name, **kwargs)
+
+    def partition(self, num_clients, method='iid', alpha=0.5, seed=None):
+        # see partition.py
+        from .partition import partition_dataset
+        return partition_dataset(self, num_clients, method, alpha, seed)
+
+    def split(self, fractions=None, seed=None, stratify=True):
+        # see split.py
+        from .split import split_dataset
+        return split_dataset(self, fractions, seed, stratify)
+
+    def select(self, columns=None, rows=None):
+        if columns is None and rows is None:
+            return self
+        return Dataset(self.name, self.type, self.label_name, [party.select(columns, rows) for party in self.parties], self.options)
+
+    def to_dict(self):
+        return {'name': self.name, 'type': self.type, 'label_name': self.label_name, 'parties': list(self.parties), 'options': self.options}
 
     def to_json(self):
-        dataset_to_json = Dataset(self.name, self.type, self.label_name, [party.name for party in self.parties], self.options)
-        return json.dumps(dataset_to_json, indent=4, default=lambda x: x.__dict__)
+        return json.dumps({
+            'name': self.name,
+            'type': self.type,
+            'label_name': self.label_name,
+            'parties': self.party_names(),
+            'options': self.options,
+        }, indent=4)
+
 
+def load_party_from_json(in_dir, party_name, columns=None, rows=None):
+    with open(os.path.join(in_dir, party_name+'.json'), 'r') as infile:
+        party = json.load(infile)
+    party = Party(party['name'], party['column_name'], party['records'])
+    if columns is None and rows is None:
+        return party
+    return party.select(columns, rows)
 
-def load_from_json(in_dir):
+
+def load_from_json(in_dir, lazy=False, max_resident=None, workers=None, columns=None, rows=None):
+    # lazy: parties are only read from disk when dataset.parties[i] is accessed, at most max_resident stay in memory
+    # workers: otherwise parse the party files in a pool of this many processes
+    # columns / rows: see Party.select, json has to be parsed in full before they are applied
     if not os.path.exists(in_dir):
         return None
     with open(os.path.join(in_dir, '_main.json'), 'r') as infile:
         dataset = json.load(infile)
-    parties = []
-    for party_name in dataset['parties']:
-        with open(os.path.join(in_dir, party_name+'.json'), 'r') as infile:
-            party = json.load(infile)
-            parties.append(Party(party['name'], party['column_name'], party['records']))
+    loader = partial(load_party_from_json, in_dir, columns=columns, rows=rows)
+    if lazy:
+        parties = LazyParties(dataset['parties'], loader, max_resident)
+    else:
+        parties = pool_map(loader, dataset['parties'], workers=workers)
     return Dataset(dataset['name'], dataset['type'], dataset['label_name'], parties, dataset['options'])
 
 
-def save_to_json(dataset, out_dir):
+def save_party_to_json(out_dir, indent, party):
+    with open(os.path.join(out_dir, party.name+'.json'), 'w') as outfile:
+        index = party.dump_json(outfile, indent)
+    np.save(os.path.join(out_dir, party.name+'.index.npy'), index)
+
+
+def open_party_from_json(in_dir, party_name, column_name):
+    # a party served straight from its json file through the offset index written by save_to_json, nothing is parsed up front
+    index = np.load(os.path.join(in_dir, party_name+'.index.npy'), mmap_mode='r')
+    return Party(party_name, column_name, JsonRecords(os.path.join(in_dir, party_name+'.json'), index))
+
+
+def save_to_json(dataset, out_dir, indent=4, workers=None):
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
     with open(os.path.join(out_dir, '_main.json'), 'w') as outfile:
         outfile.write(dataset.to_json())
-    for party in dataset.parties:
-        with open(os.path.join(out_dir, party.name+'.json'), 'w') as outfile:
-            outfile.write(party.to_json())
+    pool_map(partial(save_party_to_json, out_dir, indent), dataset.parties, workers=workers)
@@ -1,5 +1,8 @@
+import tempfile
 import pandas as pd
 from .dataset import Dataset, Party
+from .columns import columns_from_pandas
+from .sources import DataSource, sha256_file
 
 FATE_DATA_URL = 'https://raw.githubusercontent.com/FederatedAI/FATE/12c25950633fdcc151b671760ff2529320a5ee79/examples/data/'
 FATE_DATASETS = {
@@ -21,18 +24,41 @@ FATE_DATASETS = {
     'vehicle_scale_vertical': [Dataset('vehicle_scale_vertical', 1, 'y', ['vehicle_scale_hetero_guest', 'vehicle_scale_hetero_host'], {'unique_id': 'id'}), None],
     'vehicle_scale_horizontal': [Dataset('vehicle_scale_horizontal', 0, 'y', ['vehicle_scale_homo_guest', 'vehicle_scale_homo_host']), None],
 }
+# sha256 of <party>.csv at the commit of FATE_DATA_URL as given by fate_checksums(), files fetched from FATE or a mirror must
+# match them; files without an entry are checked against the hash pinned the first time they were fetched (see DataSource)
+FATE_CHECKSUMS = {}
 
 
-def download_convert_fate(fate_dataset_name):
+def fate_party_names(fate_dataset_name):
+    party_names = [party_name for dataset in FATE_DATASETS[fate_dataset_name] if dataset is not None for party_name in dataset.parties]
+    return list(dict.fromkeys(party_names))
+
+
+def fate_checksums(source=None):
+    # the FATE_CHECKSUMS of every csv of FATE_DATASETS as fetched from source, used to pin them when FATE_DATA_URL changes
+    paths = list(dict.fromkeys(party_name+'.csv' for name in FATE_DATASETS for party_name in fate_party_names(name)))
+    with tempfile.TemporaryDirectory() as raw_dir:
+        if source is None:
+            source = DataSource(FATE_DATA_URL, raw_dir)
+        return {path: sha256_file(local) for path, local in zip(paths, source.fetch_all(paths))}
+
+
+def download_convert_fate(fate_dataset_name, source=None, checksums=FATE_CHECKSUMS):
+    # source: where the csv files are fetched from (see sources.py), FATE_DATA_URL without a raw download cache by default;
+    # checksums: {<party>.csv: sha256} the fetched files are checked against
+    if source is None:
+        source = DataSource(FATE_DATA_URL)
+    party_names = fate_party_names(fate_dataset_name)
+    paths = dict(zip(party_names, source.fetch_all([party_name+'.csv' for party_name in party_names], checksums)))
     train_parties = []
     train_dataset = FATE_DATASETS[fate_dataset_name][0]
     for party_name in train_dataset.parties:
-        df = pd.read_csv(FATE_DATA_URL+party_name+'.csv')
-        n, m = df.shape
-        values = [[df.iat[i, j].item() for j in range(m)] for i in range(n)]
-        train_parties.append(Party(party_name, df.columns.tolist(), values))
-    if fate_dataset_name == 'give_credit_vertical':
-        train_parties[1].records = train_parties[1].records[:120000]
+        if fate_dataset_name == 'give_credit_vertical' and party_name == 'give_credit_hetero_host':
+            # the first 120000 host rows pair with the guest table, only those are read
+            df = pd.read_csv(paths[party_name], nrows=120000)
+        else:
+            df = pd.read_csv(paths[party_name])
+        train_parties.append(Party(party_name, df.columns.tolist(), columns=columns_from_pandas(df)))
     train_dataset = Dataset(train_dataset.name, train_dataset.type, train_dataset.label_name, train_parties, train_dataset.options)
 
     if FATE_DATASETS[fate_dataset_name][1] is None:
@@ -40,12 +66,13 @@ def download_convert_fate(fate_dataset_name):
     test_parties = []
     test_dataset = FATE_DATASETS[fate_dataset_name][1]
     for party_name in test_dataset.parties:
-        df = pd.read_csv(FATE_DATA_URL+party_name+'.csv')
-        n, m = df.shape
-        values = [[df.iat[i, j].item() for j in range(m)] for i in range(n)]
-        test_parties.append(Party(party_name, df.columns.tolist(), values))
+        if fate_dataset_name == 'give_credit_vertical' and party_name == 'give_credit_hetero_host':
+            # the remaining host rows pair with the test table
+            df = pd.read_csv(paths[party_name], skiprows=range(1, 120001))
+        else:
+            df = pd.read_csv(paths[party_name])
+        test_parties.append(Party(party_name, df.columns.tolist(), columns=columns_from_pandas(df)))
     if fate_dataset_name == 'give_credit_vertical':
-        test_parties[1].records = test_parties[1].records[120000:]
         test_parties[0].name = 'give_credit_hetero_guest'
     test_dataset = Dataset(test_dataset.name, test_dataset.type, test_dataset.label_name, test_parties, test_dataset.options)
     return train_dataset, test_dataset
@@ -1,66 +1,137 @@
 import os
 import shutil
-from .dataset import save_to_json, load_from_json
-from .leaf import download_leaf, get_leaf_args, preprocess_leaf, convert_leaf
-from .fate import download_convert_fate
+from .storage import FORMATS, save_dataset, load_dataset, check_cache, check_legacy_cache
+from .cache import VARIANTS_DIR, variant_key, variant_dir, activate_variant, evict_variants, \
+    cache_lock, is_complete, mark_complete, staging_dir, commit_staging
+from .leaf import LEAF_SOURCE_CODE, LEAF_SOURCE_CODE_COMMIT, download_leaf, get_leaf_args, preprocess_leaf, convert_leaf, \
+    fetch_raw_data, restore_raw_data, store_raw_data
+from .fate import FATE_DATA_URL, FATE_DATASETS, download_convert_fate
+from .sources import RAW_DIR, DataSource, join_url
 
 
 class FLBDatasets:
     def __init__(self,
                  dir: str = None,
+                 format: str = 'columnar',  # format of newly written caches, existing caches are loaded in whatever format they have
+                 lazy: bool = False,  # load each party of a cached dataset only when it is first accessed
+                 max_resident: int = None,  # with lazy, the maximum number of parties kept in memory per dataset
+                 workers: int = None,  # size of the process pool used to (de)serialize parties and convert leaf users
+                 max_cache_bytes: int = None,  # evict the least recently used leaf variants when they exceed this size
+                 codec: str = None,  # compress newly written columnar caches with gzip / zstd
+                 mirror: str = None,  # url or directory with fate/<party>.csv, leaf.git and leaf-data/<dataset>, defaults to $FLB_MIRROR
+                 verify: bool = False,  # check the sha256 of every file of a cache before loading it, not only its size
                  ):
         if dir is None:
             self.dir = './data'
         else:
             self.dir = os.path.expanduser(dir)
+        if format not in FORMATS:
+            raise NotImplementedError('Format {} is not supported.'.format(format))
+        self.format = format
+        self.lazy = lazy
+        self.max_resident = max_resident
+        self.workers = workers
+        self.max_cache_bytes = max_cache_bytes
+        self.codec = codec
+        self.mirror = mirror if mirror is not None else os.environ.get('FLB_MIRROR')
+        self.verify = verify
+        # raw downloads are kept by content hash, re-preparing a dataset does not fetch them again
+        self.raw_dir = os.path.join(self.dir, RAW_DIR)
 
     def leafDatasets(self,
                      dataset: str,
                      leaf_dir: str = None,
                      leaf_args: str = None,
-                     keep_leaf: bool = False
+                     keep_leaf: bool = False,
+                     columns: list = None,  # only load these columns of every party
+                     rows=None,  # only load these rows of every party (slice, range or index array)
                      ):
         if leaf_args is None:
             leaf_args = get_leaf_args(dataset)
-        if os.path.exists(os.path.join(self.dir, dataset)):
-            train_dataset = load_from_json(os.path.join(self.dir, dataset, 'train'))
-            test_dataset = load_from_json(os.path.join(self.dir, dataset, 'test'))
-            if train_dataset.options['leaf_args'] != leaf_args or test_dataset.options['leaf_args'] != leaf_args:
-                raise RuntimeError('specified arguments are different from the cache, please delete the cache and run again.')
-            if dataset == 'reddit':
-                val_dataset = load_from_json(os.path.join(self.dir, dataset, 'val'))
-                return train_dataset, test_dataset, val_dataset
-            return train_dataset, test_dataset
-        if leaf_dir is None:
-            leaf_dir = os.path.join(self.dir, '_leaf')
-        else:
-            leaf_dir = os.path.expanduser(leaf_dir)
-        download_leaf(leaf_dir)
-        preprocess_leaf(dataset, leaf_dir, leaf_args)
-        if dataset == 'reddit':
-            train_dataset, test_dataset, val_dataset = convert_leaf(dataset, leaf_dir, leaf_args)
-            save_to_json(train_dataset, os.path.join(self.dir, dataset, 'train'))
-            save_to_json(test_dataset, os.path.join(self.dir, dataset, 'test'))
-            save_to_json(val_dataset, os.path.join(self.dir, dataset, 'val'))
-            if not keep_leaf:
-                shutil.rmtree(leaf_dir)
-            return train_dataset, test_dataset, val_dataset
-        train_dataset, test_dataset = convert_leaf(dataset, leaf_dir, leaf_args)
-        save_to_json(train_dataset, os.path.join(self.dir, dataset, 'train'))
-        save_to_json(test_dataset, os.path.join(self.dir, dataset, 'test'))
-        if not keep_leaf:
-            shutil.rmtree(leaf_dir)
-        return train_dataset, test_dataset
+        # every (dataset, leaf_args, leaf commit) is cached in its own variant directory and <dir>/<dataset> links to the last one used
+        splits = ['train', 'test', 'val'] if dataset == 'reddit' else ['train', 'test']
+        link = os.path.join(self.dir, dataset)
+        with cache_lock(link):
+            if os.path.isdir(link) and not os.path.islink(link):
+                # a cache written before variants existed becomes the variant of its own arguments if all of its splits load,
+                # otherwise it is removed and rebuilt
+                try:
+                    manifests = [check_legacy_cache(os.path.join(link, split)) for split in splits]
+                    legacy_args = manifests[0]['options']['leaf_args']
+                except (OSError, ValueError, KeyError, TypeError, RuntimeError):
+                    legacy_args = None
+                if legacy_args is None:
+                    shutil.rmtree(link)
+                else:
+                    legacy_dir = variant_dir(self.dir, dataset, variant_key(dataset, legacy_args, LEAF_SOURCE_CODE_COMMIT))
+                    os.makedirs(os.path.join(self.dir, VARIANTS_DIR), exist_ok=True)
+                    mark_complete(link, splits)
+                    os.rename(link, legacy_dir)
+        cache_dir = variant_dir(self.dir, dataset, variant_key(dataset, leaf_args, LEAF_SOURCE_CODE_COMMIT))
+        if not is_complete(cache_dir):
+            with cache_lock(cache_dir):
+                # another process may have finished the same variant while this one was waiting for the lock
+                if not is_complete(cache_dir):
+                    if leaf_dir is None:
+                        leaf_dir = os.path.join(self.dir, '_leaf')
+                    else:
+                        leaf_dir = os.path.expanduser(leaf_dir)
+                    staging = staging_dir(cache_dir)
+                    with cache_lock(leaf_dir), cache_lock(self.raw_dir):
+                        leaf_url = LEAF_SOURCE_CODE if self.mirror is None else join_url(self.mirror, 'leaf.git')
+                        download_leaf(leaf_dir, url=leaf_url, raw_dir=self.raw_dir)
+                        fetch_raw_data(dataset, self.mirror, self.raw_dir)
+                        restore_raw_data(dataset, leaf_dir, self.raw_dir)
+                        preprocess_leaf(dataset, leaf_dir, leaf_args)
+                        store_raw_data(dataset, leaf_dir, self.raw_dir)
+                        # users are streamed from the leaf shards into the cache one at a time, the splits are then loaded from it
+                        convert_leaf(dataset, leaf_dir, leaf_args, self.workers, [os.path.join(staging, split) for split in splits],
+                                     self.format, self.codec)
+                        if not keep_leaf:
+                            shutil.rmtree(leaf_dir)
+                    commit_staging(staging, cache_dir, splits)
+        # the cache is validated from the manifests alone before any party is loaded
+        for split in splits:
+            if check_cache(os.path.join(cache_dir, split), self.verify)['options']['leaf_args'] != leaf_args:
+                raise RuntimeError('the cache in {} does not match its arguments, please delete it and run again.'.format(cache_dir))
+        datasets = tuple(load_dataset(os.path.join(cache_dir, split), self.lazy, self.max_resident, self.workers, columns, rows) for split in splits)
+        activate_variant(self.dir, dataset, cache_dir)
+        if self.max_cache_bytes is not None:
+            evict_variants(self.dir, self.max_cache_bytes)
+        return datasets
 
     def fateDatasets(self,
-                     dataset: str
+                     dataset: str,
+                     columns: list = None,  # only load these columns of every party
+                     rows=None,  # only load these rows of every party (slice, range or index array)
                      ):
-        if os.path.exists(os.path.join(self.dir, dataset)):
-            train_dataset = load_from_json(os.path.join(self.dir, dataset, 'train'))
-            test_dataset = load_from_json(os.path.join(self.dir, dataset, 'test'))
-            return train_dataset, test_dataset
-        train_dataset, test_dataset = download_convert_fate(dataset)
-        save_to_json(train_dataset, os.path.join(self.dir, dataset, 'train'))
-        if test_dataset is not None:
-            save_to_json(test_dataset, os.path.join(self.dir, dataset, 'test'))
+        cache_dir = os.path.join(self.dir, dataset)
+        if not is_complete(cache_dir):
+            with cache_lock(cache_dir):
+                if os.path.exists(cache_dir) and not is_complete(cache_dir):
+                    # written before completion markers existed, kept if every split the dataset has is there and all of
+                    # its parties load, rebuilt otherwise
+                    try:
+                        splits = ['train'] if FATE_DATASETS[dataset][1] is None else ['train', 'test']
+                        for split in splits:
+                            check_legacy_cache(os.path.join(cache_dir, split))
+                        mark_complete(cache_dir, splits)
+                    except (OSError, ValueError, KeyError, RuntimeError):
+                        pass
+                if not is_complete(cache_dir):
+                    fate_url = FATE_DATA_URL if self.mirror is None else join_url(self.mirror, 'fate')
+                    train_dataset, test_dataset = download_convert_fate(dataset, DataSource(fate_url, self.raw_dir, pins='fate'))
+                    staging = staging_dir(cache_dir)
+                    save_dataset(train_dataset, os.path.join(staging, 'train'), self.format, self.workers, self.codec)
+                    if test_dataset is not None:
+                        save_dataset(test_dataset, os.path.join(staging, 'test'), self.format, self.workers, self.codec)
+                    commit_staging(staging, cache_dir, ['train'] if test_dataset is None else ['train', 'test'])
+                    if test_dataset is not None:
+                        test_dataset = test_dataset.select(columns, rows)
+                    return train_dataset.select(columns, rows), test_dataset
+        for split in ['train', 'test']:
+            if os.path.exists(os.path.join(cache_dir, split)):
+                check_cache(os.path.join(cache_dir, split), self.verify)
+        train_dataset = load_dataset(os.path.join(cache_dir, 'train'), self.lazy, self.max_resident, self.workers, columns, rows)
+        test_dataset = load_dataset(os.path.join(cache_dir, 'test'), self.lazy, self.max_resident, self.workers, columns, rows)
         return train_dataset, test_dataset
@@ -0,0 +1,45 @@
+import io
+import os
+import base64
+import tempfile
+import numpy as np
+from .columns import VarColumn
+from .storage import open_party
+
+IMAGES_DIR = '_images'
+
+
+def image_bytes(column, i):
+    # the encoded image file of row i, from an image column or from base64 text (e.g. a party read from a json cache)
+    if isinstance(column, VarColumn) and column.dtype == 'image':
+        return column.raw(i)
+    return base64.b64decode(column[i])
+
+
+def decode_images(column, rows=None, size=None):
+    # the images of rows (all when None) as one (n, height, width, 3) uint8 array, resized to size=(width, height) if given
+    from PIL import Image
+    rows = range(len(column)) if rows is None else rows
+    images = []
+    for i in rows:
+        image = Image.open(io.BytesIO(image_bytes(column, i))).convert('RGB')
+        if size is not None and image.size != tuple(size):
+            image = image.resize(tuple(size), Image.BILINEAR)
+        images.append(np.asarray(image, dtype=np.uint8))
+    if len(images) == 0:
+        return np.zeros((0, size[1], size[0], 3) if size is not None else (0, 0, 0, 3), dtype=np.uint8)
+    return np.stack(images)
+
+
+def image_tensor(in_dir, party_name, column_name='x0', size=None):
+    # decode_images of one party of a cache, written to <in_dir>/_images on first use and memory-mapped afterwards
+    path = os.path.join(in_dir, IMAGES_DIR, party_name, '{}.{}.npy'.format(column_name, 'original' if size is None else '{}x{}'.format(*size)))
+    if not os.path.exists(path):
+        party = open_party(in_dir, party_name)
+        tensor = decode_images(party.to_columns()[party.column_name.index(column_name)], size=size)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tensor-')
+        with os.fdopen(fd, 'wb') as outfile:
+            np.save(outfile, tensor)
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r')
@@ -1,8 +1,13 @@
 import os
 import json
-from collections import defaultdict
-from .dataset import Dataset, Party
-import base64
+from functools import partial
+from .dataset import Dataset, Party, pool_map
+from .storage import write_party, write_manifest
+from .columns import encode_column, infer_dtype
+from .sources import DataSource, is_remote, local_path, join_url
+import hashlib
+import shutil
+import tarfile
 import subprocess
 
 LEAF_SOURCE_CODE = 'https://github.com/stneng/leaf.git'
@@ -15,55 +20,213 @@ DEFAULT_ARGS = {
     'shakespeare': '-s niid --sf 0.05 -k 64 -tf 0.9 -t sample --smplseed 1234567890 --spltseed 1234567890',
     'synthetic': '-s niid --sf 1.0 -k 5 -t sample --tf 0.6 --smplseed 1234567890 --spltseed 1234567890',
 }
+# datasets whose x are the names of image files, they are stored as image columns (see columns.py) of the raw file bytes
+IMAGE_DIRS = {
+    'celeba': os.path.join('raw', 'img_align_celeba'),
+}
+
+
+class ShardReader:
+    # incremental reader over a leaf json shard, the buffer only holds the value being parsed and the rest of one chunk;
+    # the buffer is the latin-1 decoding of the file so that positions in it are byte offsets
+    def __init__(self, infile, chunk_size):
+        self.infile = infile
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.base = 0  # byte offset of buffer[0]
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size):
+        self.base += self.pos
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        data = self.infile.read(size)
+        self.eof = len(data) == 0
+        self.buffer += data.decode('latin-1')
+        return not self.eof
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill(self.chunk_size):
+                raise ValueError('unexpected end of {}'.format(self.infile.name))
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('expected {} at byte {} of {}'.format(char, self.base+self.pos, self.infile.name))
+        self.pos += 1
+
+    def value(self):
+        # (value, start, end) of the next json value, start / end are byte offsets in the file
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    break
+            except ValueError:
+                if self.eof:
+                    raise
+            # the value is longer than the buffer, read geometrically larger chunks so it is parsed O(1) times on average
+            self.fill(size)
+            size *= 2
+        text = self.buffer[self.pos:end]
+        try:
+            text.encode('ascii')
+        except UnicodeEncodeError:
+            value = json.loads(text.encode('latin-1'))
+        start = self.base+self.pos
+        self.pos = end
+        return value, start, self.base+end
 
 
-def read_dir(data_dir):
-    # https://github.com/TalwalkarLab/leaf/blob/09ec454a5675e32e1f0546b456b77857fdece018/models/utils/model_utils.py#L29
-    clients = []
-    groups = []
-    data = defaultdict(lambda: None)
+def iter_shard(path, chunk_size=1 << 24):
+    # yields (user, start, end, user_data) for every user of a leaf json shard while reading it chunk by chunk,
+    # [start, end) are the byte offsets of the user's data in the file (see read_user)
+    with open(path, 'rb') as infile:
+        reader = ShardReader(infile, chunk_size)
+        reader.expect('{')
+        while reader.peek() != '}':
+            key, _, _ = reader.value()
+            reader.expect(':')
+            if key == 'user_data':
+                reader.expect('{')
+                while reader.peek() != '}':
+                    user, _, _ = reader.value()
+                    reader.expect(':')
+                    user_data, start, end = reader.value()
+                    yield user, start, end, user_data
+                    if reader.peek() == ',':
+                        reader.pos += 1
+                reader.expect('}')
+            else:
+                # users, num_samples and hierarchies are not used
+                reader.value()
+            if reader.peek() == ',':
+                reader.pos += 1
+        reader.expect('}')
 
-    files = os.listdir(data_dir)
-    files = [f for f in files if f.endswith('.json')]
-    for f in files:
-        file_path = os.path.join(data_dir, f)
-        with open(file_path, 'r') as inf:
-            cdata = json.load(inf)
-        clients.extend(cdata['users'])
-        if 'hierarchies' in cdata:
-            groups.extend(cdata['hierarchies'])
-        data.update(cdata['user_data'])
 
-    clients = list(sorted(data.keys()))
-    return clients, groups, data
+def index_shard(path):
+    return [(user, path, start, end) for user, start, end, _ in iter_shard(path)]
 
 
-def read_data(train_data_dir, test_data_dir):
-    # https://github.com/TalwalkarLab/leaf/blob/09ec454a5675e32e1f0546b456b77857fdece018/models/utils/model_utils.py#L49
-    train_clients, train_groups, train_data = read_dir(train_data_dir)
-    test_clients, test_groups, test_data = read_dir(test_data_dir)
+def index_dirs(data_dirs, workers=None):
+    # {user: (path, start, end)} over the shards of each split, a user in a later shard replaces an earlier one;
+    # with workers the shards of all splits are indexed in one process pool
+    files = [[os.path.join(data_dir, f) for f in os.listdir(data_dir) if f.endswith('.json')] for data_dir in data_dirs]
+    shard_indexes = iter(pool_map(index_shard, [path for paths in files for path in paths], workers=workers))
+    indexes = []
+    for paths in files:
+        index = {}
+        for _ in paths:
+            index.update((user, (path, start, end)) for user, path, start, end in next(shard_indexes))
+        indexes.append(index)
+    return indexes
 
-    assert train_clients == test_clients
-    assert train_groups == test_groups
 
-    return train_clients, train_groups, train_data, test_data
+def read_user(location):
+    path, start, end = location
+    with open(path, 'rb') as infile:
+        infile.seek(start)
+        return json.loads(infile.read(end-start))
 
 
-def download_leaf(leaf_dir):
+def download_leaf(leaf_dir, url=LEAF_SOURCE_CODE, raw_dir=None):
+    # url: the leaf repository or a mirror of it; with raw_dir a bare mirror clone is kept there and only fetched from
+    # when it does not have LEAF_SOURCE_CODE_COMMIT yet, so preparing another dataset does not clone again
     if os.path.exists(leaf_dir):
         return
-    bash_cmd = 'git clone '+LEAF_SOURCE_CODE+' '+leaf_dir
+    if raw_dir is not None:
+        mirror_dir = os.path.join(raw_dir, 'leaf-'+hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]+'.git')
+        if not os.path.exists(mirror_dir):
+            subprocess.run(['git', 'clone', '--mirror', url, mirror_dir], check=True)
+        elif subprocess.run(['git', 'cat-file', '-e', LEAF_SOURCE_CODE_COMMIT+'^{commit}'], cwd=mirror_dir).returncode != 0:
+            subprocess.run(['git', 'fetch', '--prune', 'origin'], cwd=mirror_dir, check=True)
+        url = mirror_dir
+    bash_cmd = 'git clone '+url+' '+leaf_dir
     subprocess.run(bash_cmd, shell=True, check=True)
     bash_cmd = 'git checkout '+LEAF_SOURCE_CODE_COMMIT
     subprocess.run(bash_cmd, shell=True, cwd=leaf_dir, check=True)
 
 
+def raw_data_dir(dataset, leaf_dir):
+    return os.path.join(leaf_dir, 'data', dataset, 'data', 'raw_data')
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def fetch_raw_data(dataset, mirror, raw_dir):
+    # the files preprocess.sh would download for dataset, taken from <mirror>/leaf-data/<dataset> (a directory of a local
+    # mirror) or <mirror>/leaf-data/<dataset>.tar.gz into the raw data cache, so that hosts without internet access can prepare it
+    cached_dir = os.path.join(raw_dir, 'leaf-data', dataset)
+    if mirror is None or os.path.exists(cached_dir):
+        return
+    url = join_url(mirror, 'leaf-data/'+dataset)
+    os.makedirs(os.path.dirname(cached_dir), exist_ok=True)
+    if os.path.exists(cached_dir+'.tmp'):
+        shutil.rmtree(cached_dir+'.tmp')
+    # the files are checked against the hashes pinned the first time they were taken from a mirror (see DataSource)
+    source = DataSource(mirror, raw_dir, pins='leaf')
+    if not is_remote(url) and os.path.isdir(local_path(url)):
+        for dir_path, _, file_names in os.walk(local_path(url)):
+            for file_name in file_names:
+                path = os.path.relpath(os.path.join(dir_path, file_name), local_path(url))
+                source.fetch('leaf-data/'+dataset+'/'+path.replace(os.sep, '/'))
+        shutil.copytree(local_path(url), cached_dir+'.tmp', copy_function=link_or_copy)
+    else:
+        try:
+            path = source.fetch('leaf-data/'+dataset+'.tar.gz')
+        except OSError:
+            # not mirrored, preprocess.sh downloads the files
+            return
+        if not os.path.isfile(path):
+            return
+        with tarfile.open(path) as tar:
+            tar.extractall(cached_dir+'.tmp', **({'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}))
+    os.rename(cached_dir+'.tmp', cached_dir)
+
+
+def restore_raw_data(dataset, leaf_dir, raw_dir):
+    # the files preprocess.sh downloaded for dataset last time, hard-linked back into the new checkout so they are not downloaded again
+    cached_dir = os.path.join(raw_dir, 'leaf-data', dataset)
+    if os.path.exists(cached_dir) and not os.path.exists(raw_data_dir(dataset, leaf_dir)):
+        shutil.copytree(cached_dir, raw_data_dir(dataset, leaf_dir), copy_function=link_or_copy)
+
+
+def store_raw_data(dataset, leaf_dir, raw_dir):
+    cached_dir = os.path.join(raw_dir, 'leaf-data', dataset)
+    if os.path.exists(raw_data_dir(dataset, leaf_dir)) and not os.path.exists(cached_dir):
+        os.makedirs(os.path.dirname(cached_dir), exist_ok=True)
+        if os.path.exists(cached_dir+'.tmp'):
+            shutil.rmtree(cached_dir+'.tmp')
+        shutil.copytree(raw_data_dir(dataset, leaf_dir), cached_dir+'.tmp', copy_function=link_or_copy)
+        os.rename(cached_dir+'.tmp', cached_dir)
+
+
 def get_leaf_args(dataset):
     return DEFAULT_ARGS[dataset]
 
 
 def preprocess_leaf(dataset, leaf_dir, args):
     bash_dir = os.path.join(leaf_dir, 'data', dataset)
+    if dataset != 'reddit':
+        # preprocess.sh skips sampling and splitting when their outputs already exist, which would reuse the previous arguments
+        for name in ['sampled_data', 'rem_user_data', 'train', 'test']:
+            if os.path.exists(os.path.join(bash_dir, 'data', name)):
+                shutil.rmtree(os.path.join(bash_dir, 'data', name))
     if dataset == 'synthetic':
         subprocess.run('python3 main.py -num-tasks 1000 -num-classes 5 -num-dim 60', shell=True, cwd=bash_dir, check=True)
     bash_cmd = 'bash preprocess.sh'+' '+args
@@ -71,65 +234,59 @@ def preprocess_leaf(dataset, leaf_dir, args):
     subprocess.run(bash_cmd, shell=True, cwd=bash_dir, check=True)
 
 
-def encode_image(leaf_dir, img_name):
-    with open(os.path.join(leaf_dir, 'data', 'celeba', 'data', 'raw', 'img_align_celeba', img_name), 'rb') as f:
-        b64 = base64.b64encode(f.read())
-    return b64.decode('utf-8')
-
-
-def convert_leaf(dataset, leaf_dir, args):
-    train_data_dir = os.path.join(leaf_dir, 'data', dataset, 'data', 'train')
-    test_data_dir = os.path.join(leaf_dir, 'data', dataset, 'data', 'test')
-    users, groups, train_data, test_data = read_data(train_data_dir, test_data_dir)
-    if dataset == 'reddit':
-        _, _, val_data = read_dir(os.path.join(leaf_dir, 'data', dataset, 'data', 'val'))
-    train_parties = []
-    test_parties = []
-    val_parties = []
-    for user in users:
-        train_num_records = len(train_data[user]['y'])
-        if dataset in ['shakespeare', 'reddit', 'celeba']:
-            train_num_columns = 2
-        else:
-            train_num_columns = len(train_data[user]['x'][0])+1
-        train_column_name = ['y']+['x'+str(i) for i in range(train_num_columns-1)]
-        if dataset in ['shakespeare', 'reddit']:
-            train_records = [[train_data[user]['y'][i], train_data[user]['x'][i]] for i in range(train_num_records)]
-        elif dataset == 'celeba':
-            train_records = [[train_data[user]['y'][i], encode_image(
-                leaf_dir, train_data[user]['x'][i])] for i in range(train_num_records)]
-        else:
-            train_records = [[train_data[user]['y'][i]]+train_data[user]['x'][i] for i in range(train_num_records)]
-        train_parties.append(Party(user, train_column_name, train_records))
-
-        test_num_records = len(test_data[user]['y'])
-        if dataset in ['shakespeare', 'reddit', 'celeba']:
-            test_num_columns = 2
-        else:
-            test_num_columns = len(test_data[user]['x'][0])+1
-        test_column_name = ['y']+['x'+str(i) for i in range(test_num_columns-1)]
-        if dataset in ['shakespeare', 'reddit']:
-            test_records = [[test_data[user]['y'][i], test_data[user]['x'][i]] for i in range(test_num_records)]
-        elif dataset == 'celeba':
-            test_records = [[test_data[user]['y'][i], encode_image(
-                leaf_dir, test_data[user]['x'][i])] for i in range(test_num_records)]
-        else:
-            test_records = [[test_data[user]['y'][i]]+test_data[user]['x'][i] for i in range(test_num_records)]
-        test_parties.append(Party(user, test_column_name, test_records))
-
-        if dataset == 'reddit':
-            val_num_records = len(val_data[user]['y'])
-            val_num_columns = 2
-            val_column_name = ['y']+['x'+str(i) for i in range(val_num_columns-1)]
-            val_records = [[val_data[user]['y'][i], val_data[user]['x'][i]] for i in range(val_num_records)]
-            val_parties.append(Party(user, val_column_name, val_records))
-
-    if dataset == 'reddit':
-        train_dataset = Dataset(dataset, 0, 'y', train_parties, {'leaf_args': args})
-        test_dataset = Dataset(dataset, 0, 'y', test_parties, {'leaf_args': args})
-        val_dataset = Dataset(dataset, 0, 'y', val_parties, {'leaf_args': args})
-        return train_dataset, test_dataset, val_dataset
+def read_image(dataset, leaf_dir, img_name):
+    with open(os.path.join(leaf_dir, 'data', dataset, 'data', IMAGE_DIRS[dataset], img_name), 'rb') as f:
+        return f.read()
+
+
+def convert_records(dataset, user_data):
+    num_records = len(user_data['y'])
+    if dataset in ['shakespeare', 'reddit']:
+        num_columns = 2
     else:
-        train_dataset = Dataset(dataset, 0, 'y', train_parties, {'leaf_args': args})
-        test_dataset = Dataset(dataset, 0, 'y', test_parties, {'leaf_args': args})
-        return train_dataset, test_dataset
+        num_columns = len(user_data['x'][0])+1
+    column_name = ['y']+['x'+str(i) for i in range(num_columns-1)]
+    if dataset in ['shakespeare', 'reddit']:
+        records = [[user_data['y'][i], user_data['x'][i]] for i in range(num_records)]
+    else:
+        records = [[user_data['y'][i]]+user_data['x'][i] for i in range(num_records)]
+    return column_name, records
+
+
+def convert_party(dataset, leaf_dir, user, user_data):
+    if dataset in IMAGE_DIRS:
+        # the image files are packed back to back instead of base64 text, records still show them as base64
+        images = [read_image(dataset, leaf_dir, img_name) for img_name in user_data['x']]
+        return Party(user, ['y', 'x0'], columns=[encode_column(user_data['y'], infer_dtype(user_data['y'])), encode_column(images, 'image')])
+    return Party(user, *convert_records(dataset, user_data))
+
+
+def convert_user(dataset, leaf_dir, out_dirs, format, codec, user, *locations):
+    # one party per split (train, test and for reddit val) of a single user, read from the shards by offset; with out_dirs the
+    # parties are written to out_dirs[i] right away and only their party_meta is returned, so one user is in memory at a time
+    parties = [convert_party(dataset, leaf_dir, user, read_user(location)) for location in locations]
+    if out_dirs is None:
+        return parties
+    return [write_party(out_dir, format, codec, 'y', party) for out_dir, party in zip(out_dirs, parties)]
+
+
+def convert_leaf(dataset, leaf_dir, args, workers=None, out_dirs=None, format='columnar', codec=None):
+    # the shards are indexed first (byte offsets of every user) and users are then converted one at a time in sorted order;
+    # with out_dirs each split is written there party by party (see storage.write_party) and nothing is returned,
+    # otherwise the splits are returned as datasets
+    splits = ['train', 'test', 'val'] if dataset == 'reddit' else ['train', 'test']
+    indexes = index_dirs([os.path.join(leaf_dir, 'data', dataset, 'data', split) for split in splits], workers)
+    users = sorted(indexes[0])
+    if any(sorted(index) != users for index in indexes[1:]):
+        raise RuntimeError('the splits of {} in {} do not have the same users.'.format(dataset, leaf_dir))
+    if out_dirs is not None:
+        for out_dir in out_dirs:
+            os.makedirs(out_dir, exist_ok=True)
+    # users are independent, so with workers they are converted in a process pool: every worker reads its users from the shards
+    # by offset and writes their parties itself, results come back in the order of users so the output is the same as without workers
+    results = pool_map(partial(convert_user, dataset, leaf_dir, out_dirs, format, codec), users, *[[index[user] for user in users] for index in indexes],
+                       workers=workers, chunksize=max(1, len(users)//(4*workers)) if workers else 1)
+    if out_dirs is None:
+        return tuple(Dataset(dataset, 0, 'y', [parties[i] for parties in results], {'leaf_args': args}) for i in range(len(splits)))
+    for i, out_dir in enumerate(out_dirs):
+        write_manifest(Dataset(dataset, 0, 'y', users, {'leaf_args': args}), out_dir, format, [party_meta[i] for party_meta in results])
@@ -0,0 +1,116 @@
+import numpy as np
+from .dataset import Dataset, Party
+from .columns import VarColumn, concat_columns, select_rows
+
+PARTITION_METHODS = ['iid', 'dirichlet', 'quantity', 'feature']
+
+
+def assign_rows(num_records, num_clients, method, rng, labels=None, alpha=0.5):
+    # the client of every row: iid splits a permutation evenly, quantity draws the client sizes from Dir(alpha),
+    # dirichlet draws for every label the share of each client from Dir(alpha) (label skew, smaller alpha is more skewed)
+    if method == 'iid':
+        assignment = np.empty(num_records, dtype=np.int64)
+        assignment[rng.permutation(num_records)] = np.arange(num_records) % num_clients
+        return assignment
+    if method == 'quantity':
+        sizes = rng.multinomial(num_records, rng.dirichlet(np.full(num_clients, alpha)))
+        assignment = np.empty(num_records, dtype=np.int64)
+        assignment[rng.permutation(num_records)] = np.repeat(np.arange(num_clients), sizes)
+        return assignment
+    if method == 'dirichlet':
+        if labels is None:
+            raise RuntimeError('the dirichlet partition needs a label column.')
+        _, label_ids = np.unique(labels, return_inverse=True)
+        label_ids = label_ids.reshape(-1)
+        num_labels = int(label_ids.max())+1 if num_records > 0 else 0
+        class_sizes = np.bincount(label_ids, minlength=num_labels)
+        # counts[c, k]: rows of label c that go to client k
+        counts = rng.multinomial(class_sizes, rng.dirichlet(np.full(num_clients, alpha), size=num_labels))
+        rows = rng.permutation(num_records)
+        rows = rows[np.argsort(label_ids[rows], kind='stable')]
+        assignment = np.empty(num_records, dtype=np.int64)
+        assignment[rows] = np.repeat(np.tile(np.arange(num_clients), num_labels), counts.reshape(-1))
+        return assignment
+    raise NotImplementedError('Partition method {} is not supported.'.format(method))
+
+
+def label_array(column):
+    if isinstance(column, VarColumn):
+        # labels are compared by their encoded text
+        return np.array([column.data[column.offsets[i]:column.offsets[i+1]].tobytes() for i in range(len(column))])
+    return np.asarray(column)
+
+
+def partition_rows(dataset, num_clients, method, rng, alpha):
+    # all parties of a horizontal dataset are pooled (they share column_name) and their rows are dealt out to the clients,
+    # every column is gathered once in client order and each client is a slice of it
+    parties = list(dataset.parties)
+    column_name = parties[0].column_name
+    if any(party.column_name != column_name for party in parties):
+        raise RuntimeError('the parties of {} have different columns and can not be pooled.'.format(dataset.name))
+    party_columns = [party.to_columns() for party in parties]
+    columns = [concat_columns([party[j] for party in party_columns]) for j in range(len(column_name))]
+    num_records = len(columns[0]) if len(columns) > 0 else 0
+    labels = label_array(columns[column_name.index(dataset.label_name)]) if dataset.label_name in column_name else None
+    assignment = assign_rows(num_records, num_clients, method, rng, labels, alpha)
+    order = np.argsort(assignment, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=num_clients))])
+    columns = [select_rows(column, order) for column in columns]
+    return [Party(dataset.name+'_'+str(k), column_name, columns=[column[bounds[k]:bounds[k+1]] for column in columns])
+            for k in range(num_clients)]
+
+
+def partition_features(dataset, num_clients):
+    # the feature columns of all parties are split into num_clients contiguous groups, every client keeps the unique_id
+    # column and the first client also gets the label, like the guest of a vertical FATE dataset; the rows of the parties
+    # are joined by unique_id (see Dataset.align), so only the ids every party has are kept
+    parties = list(dataset.parties)
+    unique_id = (dataset.options or {}).get('unique_id')
+    if unique_id is None and len(parties) > 1:
+        raise RuntimeError('the dataset {} has no unique_id to join the features of its parties by.'.format(dataset.name))
+    party_columns = [party.to_columns() for party in parties]
+    if unique_id is not None:
+        rows, _ = dataset.align()
+        # parties that are already in the order of the intersection are not copied
+        party_columns = [columns if np.array_equal(party_rows, np.arange(len(party.records))) else
+                         [select_rows(column, party_rows) for column in columns]
+                         for party, columns, party_rows in zip(parties, party_columns, rows)]
+    names, columns = [], []
+    id_column, label_column = None, None
+    for party, party_column in zip(parties, party_columns):
+        for name, column in zip(party.column_name, party_column):
+            if name == unique_id:
+                id_column = id_column if id_column is not None else column
+            elif name == dataset.label_name:
+                label_column = label_column if label_column is not None else column
+            elif name not in names:
+                names.append(name)
+                columns.append(column)
+    clients = []
+    for k, group in enumerate(np.array_split(np.arange(len(names)), num_clients)):
+        client_names = [names[j] for j in group]
+        client_columns = [columns[j] for j in group]
+        if k == 0 and label_column is not None:
+            client_names.insert(0, dataset.label_name)
+            client_columns.insert(0, label_column)
+        if id_column is not None:
+            client_names.insert(0, unique_id)
+            client_columns.insert(0, id_column)
+        clients.append(Party(dataset.name+'_'+str(k), client_names, columns=client_columns))
+    return clients
+
+
+def partition_dataset(dataset, num_clients, method='iid', alpha=0.5, seed=None):
+    # iid / dirichlet / quantity re-partition the rows of a horizontal dataset, feature splits the columns of a vertical one;
+    # the parties of the result are columnar, save_dataset writes them without converting records
+    if method not in PARTITION_METHODS:
+        raise NotImplementedError('Partition method {} is not supported.'.format(method))
+    if method == 'feature':
+        parties = partition_features(dataset, num_clients)
+        type = 1
+    else:
+        parties = partition_rows(dataset, num_clients, method, np.random.default_rng(seed), alpha)
+        type = 0
+    options = dict(dataset.options or {})
+    options['partition'] = {'method': method, 'num_clients': num_clients, 'alpha': alpha, 'seed': seed}
+    return Dataset(dataset.name, type, dataset.label_name, parties, options)
@@ -0,0 +1,41 @@
+import numpy as np
+from .storage import read_manifest
+
+
+def client_schedule(num_clients, rounds, clients_per_round, seed=0, weights=None, chunk_rounds=256):
+    # (rounds, clients_per_round) int32 array, row r holds the clients of round r (sorted, sampled without replacement),
+    # the same arguments give the same schedule on every host; with weights clients are drawn proportionally to them
+    # (Efraimidis-Spirakis keys log(u)/w, the clients with the largest keys are taken), clients with weight 0 come last
+    clients_per_round = min(clients_per_round, num_clients)
+    weights = np.ones(num_clients) if weights is None else np.asarray(weights, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    schedule = np.empty((rounds, clients_per_round), dtype=np.int32)
+    for start in range(0, rounds, chunk_rounds):
+        stop = min(start+chunk_rounds, rounds)
+        with np.errstate(divide='ignore'):
+            keys = np.log(rng.random((stop-start, num_clients)))/weights
+        if clients_per_round < num_clients:
+            chosen = np.argpartition(-keys, clients_per_round-1, axis=1)[:, :clients_per_round]
+        else:
+            chosen = np.broadcast_to(np.arange(num_clients), keys.shape)
+        schedule[start:stop] = np.sort(chosen, axis=1)
+    return schedule
+
+
+def dataset_schedule(in_dir, rounds, clients_per_round, seed=0, weighted=False):
+    # the schedule over the parties of a cached dataset, weighted by their row counts from _main.json if weighted
+    manifest = read_manifest(in_dir)
+    weights = None
+    if weighted:
+        if 'party_meta' not in manifest:
+            raise RuntimeError('the cache in {} has no row counts, please delete it and run again.'.format(in_dir))
+        weights = [meta['num_records'] for meta in manifest['party_meta']]
+    return client_schedule(len(manifest['parties']), rounds, clients_per_round, seed, weights)
+
+
+def save_schedule(path, schedule):
+    np.save(path, schedule)
+
+
+def load_schedule(path):
+    return np.load(path, mmap_mode='r')
@@ -0,0 +1,174 @@
+import sys
+import json
+import struct
+import numpy as np
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+from .dataset import Dataset, Party
+from .columns import NUMERIC_DTYPES, VarColumn
+from .storage import column_blocks, column_dtype
+
+ALIGNMENT = 64
+
+
+def require_shared_memory():
+    if shared_memory is None:
+        raise ImportError('shared datasets require multiprocessing.shared_memory, please use python 3.8 or newer.')
+
+
+def align(position):
+    return (position+ALIGNMENT-1)//ALIGNMENT*ALIGNMENT
+
+
+class SharedDataset:
+    # a Dataset whose columns live in one shared memory segment, publish_dataset creates it and attach_dataset opens it by name
+    def __init__(self,
+                 shm,  # multiprocessing.shared_memory.SharedMemory
+                 dataset: Dataset,
+                 owner: bool,  # the owner unlinks the segment on close
+                 ):
+        self.shm = shm
+        self.dataset = dataset
+        self.owner = owner
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        self.dataset = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # arrays of the dataset are still referenced, the mapping goes away with them
+            pass
+        if self.owner:
+            self.shm.unlink()
+            self.owner = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def party_layout(party, position):
+    # numeric runs are fortran-ordered blocks like in the columnar cache, so Party.to_numpy stays a view
+    columns = party.to_columns()
+    dtypes = [column_dtype(column) for column in columns]
+    blocks = []
+    for start, stop in column_blocks(dtypes):
+        if dtypes[start] in NUMERIC_DTYPES:
+            position = align(position)
+            blocks.append({'start': start, 'width': stop-start, 'dtype': dtypes[start], 'offset': position})
+            position += len(party.records)*(stop-start)*np.dtype(dtypes[start]).itemsize
+        else:
+            column = columns[start]
+            position = align(position)
+            block = {'start': start, 'width': 1, 'dtype': dtypes[start], 'offsets_offset': position}
+            position = align(position+(len(column)+1)*8)
+            block['data_offset'] = position
+            block['data_size'] = int(column.offsets[-1]-column.offsets[0])
+            position += block['data_size']
+            blocks.append(block)
+    return {'name': party.name, 'column_name': party.column_name, 'num_records': len(party.records), 'blocks': blocks}, columns, position
+
+
+def write_party(buf, layout, columns):
+    n = layout['num_records']
+    for block in layout['blocks']:
+        if block['dtype'] in NUMERIC_DTYPES:
+            array = np.ndarray((n, block['width']), dtype=block['dtype'], buffer=buf, offset=block['offset'], order='F')
+            for t in range(block['width']):
+                array[:, t] = columns[block['start']+t]
+        else:
+            column = columns[block['start']]
+            offsets = np.ndarray(n+1, dtype=np.int64, buffer=buf, offset=block['offsets_offset'])
+            offsets[:] = column.offsets-column.offsets[0]
+            data = np.ndarray(block['data_size'], dtype=np.uint8, buffer=buf, offset=block['data_offset'])
+            data[:] = column.data[column.offsets[0]:column.offsets[-1]]
+
+
+def read_party(buf, layout):
+    n = layout['num_records']
+    columns = []
+    for block in layout['blocks']:
+        if block['dtype'] in NUMERIC_DTYPES:
+            array = np.ndarray((n, block['width']), dtype=block['dtype'], buffer=buf, offset=block['offset'], order='F')
+            array.flags.writeable = False
+            columns.extend(array[:, t] for t in range(block['width']))
+        else:
+            offsets = np.ndarray(n+1, dtype=np.int64, buffer=buf, offset=block['offsets_offset'])
+            data = np.ndarray(block['data_size'], dtype=np.uint8, buffer=buf, offset=block['data_offset'])
+            offsets.flags.writeable = False
+            data.flags.writeable = False
+            columns.append(VarColumn(block['dtype'], data, offsets))
+    return Party(layout['name'], layout['column_name'], columns=columns)
+
+
+def read_header(buf):
+    # the segment starts with the length of a json header describing every block, the blocks follow it
+    length, = struct.unpack_from('<Q', buf, 0)
+    return json.loads(bytes(buf[8:8+length])), align(8+length)
+
+
+def publish_dataset(dataset, name=None):
+    # copies every party of dataset once into a shared memory segment, other processes on the host attach to it by name
+    # instead of loading their own copy; the returned SharedDataset must stay open (and is unlinked on close) while they run
+    require_shared_memory()
+    layouts, party_columns = [], []
+    position = 0
+    for party in dataset.parties:
+        layout, columns, position = party_layout(party, position)
+        layouts.append(layout)
+        party_columns.append(columns)
+    header = json.dumps({
+        'name': dataset.name,
+        'type': dataset.type,
+        'label_name': dataset.label_name,
+        'options': dataset.options,
+        'parties': layouts,
+    }).encode('utf-8')
+    data_start = align(8+len(header))
+    shm = shared_memory.SharedMemory(name=name, create=True, size=max(1, data_start+position))
+    try:
+        struct.pack_into('<Q', shm.buf, 0, len(header))
+        shm.buf[8:8+len(header)] = header
+        data = shm.buf[data_start:]
+        for layout, columns in zip(layouts, party_columns):
+            write_party(data, layout, columns)
+        data.release()
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    return attach(shm, True)
+
+
+def attach(shm, owner):
+    header, data_start = read_header(shm.buf)
+    data = shm.buf[data_start:]
+    parties = [read_party(data, layout) for layout in header['parties']]
+    dataset = Dataset(header['name'], header['type'], header['label_name'], parties, header['options'])
+    return SharedDataset(shm, dataset, owner)
+
+
+def attach_dataset(name):
+    # the returned dataset is read-only and copies nothing, close() detaches without removing the segment
+    # an attached segment must not be registered with the resource tracker, which would unlink it when this process exits
+    require_shared_memory()
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        # unregistering afterwards is not enough, child processes share the tracker of their parent
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+    return attach(shm, False)
@@ -0,0 +1,134 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+RAW_DIR = '_raw'
+FETCH_WORKERS = 8
+
+
+def sha256_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def join_url(base, path):
+    return base.rstrip('/')+'/'+path
+
+
+def is_remote(url):
+    return urllib.parse.urlparse(url).scheme in ['http', 'https', 'ftp']
+
+
+def local_path(url):
+    # file:// urls and plain paths are read in place
+    if url.startswith('file://'):
+        return urllib.request.url2pathname(urllib.parse.urlparse(url).path)
+    return os.path.expanduser(url)
+
+
+class DataSource:
+    # files below base (http(s)://, file:// or a local directory such as a mirror), downloads are kept in raw_dir by the
+    # sha256 of their content and every url remembers the hash it resolved to, so a file is only transferred once
+    def __init__(self,
+                 base: str,
+                 raw_dir: str = None,  # cache of downloaded files, remote files are not cached when None
+                 workers: int = FETCH_WORKERS,  # number of files downloaded at the same time
+                 pins: str = None,  # with raw_dir, the sha256 of a path without a given checksum is recorded under this name
+                 # the first time it is fetched and later fetches of the path, from base or any other source with the same pins, must match it
+                 ):
+        self.base = base
+        self.raw_dir = raw_dir
+        self.workers = workers
+        self.pins = pins
+
+    def url(self, path):
+        return join_url(self.base, path)
+
+    def url_record(self, url):
+        return os.path.join(self.raw_dir, 'urls', hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def blob_path(self, sha256):
+        return os.path.join(self.raw_dir, 'blobs', sha256[:2], sha256)
+
+    def pin_record(self, path):
+        return os.path.join(self.raw_dir, 'pins', self.pins, hashlib.sha256(path.encode('utf-8')).hexdigest())
+
+    def pinned(self, path):
+        if self.raw_dir is None or self.pins is None or not os.path.exists(self.pin_record(path)):
+            return None
+        with open(self.pin_record(path), 'r') as infile:
+            return infile.read().strip()
+
+    def pin(self, path, sha256):
+        os.makedirs(os.path.dirname(self.pin_record(path)), exist_ok=True)
+        fd, record = tempfile.mkstemp(dir=os.path.dirname(self.pin_record(path)), prefix='.pin-')
+        with os.fdopen(fd, 'w') as outfile:
+            outfile.write(sha256)
+        os.replace(record, self.pin_record(path))
+
+    def cached(self, url, checksum):
+        # the cached copy of url, if there is one whose content still has the hash it was stored under
+        if self.raw_dir is None or not os.path.exists(self.url_record(url)):
+            return None
+        with open(self.url_record(url), 'r') as infile:
+            sha256 = infile.read().strip()
+        if checksum is not None and sha256 != checksum:
+            return None
+        path = self.blob_path(sha256)
+        if not os.path.exists(path) or sha256_file(path) != sha256:
+            return None
+        return path
+
+    def download(self, url):
+        os.makedirs(os.path.join(self.raw_dir, 'blobs'), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.raw_dir, 'blobs'), prefix='.download-')
+        try:
+            with os.fdopen(fd, 'wb') as outfile, urllib.request.urlopen(url) as response:
+                shutil.copyfileobj(response, outfile, 1 << 20)
+            sha256 = sha256_file(tmp_path)
+            path = self.blob_path(sha256)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.makedirs(os.path.dirname(self.url_record(url)), exist_ok=True)
+        fd, record = tempfile.mkstemp(dir=os.path.dirname(self.url_record(url)), prefix='.record-')
+        with os.fdopen(fd, 'w') as outfile:
+            outfile.write(sha256)
+        os.replace(record, self.url_record(url))
+        return path
+
+    def fetch(self, path, checksum=None):
+        # a local path with the content of base/path, checksum is the expected sha256 if known (otherwise the pinned one)
+        url = self.url(path)
+        if checksum is None:
+            checksum = self.pinned(path)
+        if not is_remote(url):
+            result = local_path(url)
+        elif self.raw_dir is None:
+            # read straight from the url by the caller
+            return url
+        else:
+            result = self.cached(url, checksum)
+            if result is None:
+                result = self.download(url)
+        if checksum is not None and sha256_file(result) != checksum:
+            raise RuntimeError('the checksum of {} does not match, the source or the mirror may be corrupted.'.format(url))
+        if checksum is None and self.raw_dir is not None and self.pins is not None and os.path.isfile(result):
+            self.pin(path, sha256_file(result))
+        return result
+
+    def fetch_all(self, paths, checksums=None):
+        # fetches several files at the same time, the results are in the order of paths
+        checksums = checksums or {}
+        with ThreadPoolExecutor(self.workers) as pool:
+            return list(pool.map(lambda path: self.fetch(path, checksums.get(path)), paths))
@@ -0,0 +1,66 @@
+import numpy as np
+from .dataset import Dataset
+from .partition import label_array
+
+DEFAULT_FRACTIONS = {'train': 0.8, 'test': 0.2}
+
+
+def split_rows(num_records, fractions, rng, labels=None):
+    # the split of every row: rows are shuffled once and cut at the cumulative fractions, with labels the cut is made
+    # within every label so each split keeps the label distribution (stratified)
+    bounds = np.cumsum(fractions)[:-1]/np.sum(fractions)
+    order = rng.permutation(num_records)
+    if labels is None:
+        assignment = np.empty(num_records, dtype=np.int64)
+        assignment[order] = np.searchsorted(np.round(bounds*num_records), np.arange(num_records), side='right')
+        return assignment
+    _, label_ids = np.unique(labels, return_inverse=True)
+    label_ids = label_ids.reshape(-1)
+    order = order[np.argsort(label_ids[order], kind='stable')]
+    class_sizes = np.bincount(label_ids)
+    class_starts = np.concatenate([[0], np.cumsum(class_sizes)[:-1]])
+    sorted_ids = label_ids[order]
+    ranks = np.arange(num_records)-class_starts[sorted_ids]
+    cuts = np.round(bounds[None, :]*class_sizes[:, None])
+    assignment = np.empty(num_records, dtype=np.int64)
+    assignment[order] = (ranks[:, None] >= cuts[sorted_ids]).sum(axis=1)
+    return assignment
+
+
+def split_party(party, fractions=None, seed=None, label_name=None):
+    # {split name: Party}, rows keep their order within every split; label_name makes the split stratified
+    fractions = DEFAULT_FRACTIONS if fractions is None else fractions
+    labels = label_array(party.to_columns()[party.column_name.index(label_name)]) if label_name in party.column_name else None
+    assignment = split_rows(len(party.records), list(fractions.values()), np.random.default_rng(seed), labels)
+    return {name: party.select(rows=np.flatnonzero(assignment == i)) for i, name in enumerate(fractions)}
+
+
+def split_dataset(dataset, fractions=None, seed=None, stratify=True):
+    # {split name: Dataset}; horizontal parties are split independently (each with its own seed drawn from seed), the parties
+    # of a vertical dataset share one split of their aligned rows (see Dataset.align) so that ids stay matched
+    fractions = DEFAULT_FRACTIONS if fractions is None else fractions
+    label_name = dataset.label_name if stratify else None
+    parties = list(dataset.parties)
+    splits = {name: [] for name in fractions}
+    if dataset.type == 1:
+        if (dataset.options or {}).get('unique_id') is not None:
+            rows, size = dataset.align()
+        elif len(set(len(party.records) for party in parties)) <= 1:
+            size = len(parties[0].records) if len(parties) > 0 else 0
+            rows = [np.arange(size)]*len(parties)
+        else:
+            raise RuntimeError('the parties of {} have different numbers of rows and no unique_id to align them.'.format(dataset.name))
+        labels = None
+        for party, party_rows in zip(parties, rows):
+            if label_name in party.column_name:
+                labels = label_array(party.to_columns()[party.column_name.index(label_name)])[party_rows]
+                break
+        assignment = split_rows(size, list(fractions.values()), np.random.default_rng(seed), labels)
+        for party, party_rows in zip(parties, rows):
+            for i, name in enumerate(fractions):
+                splits[name].append(party.select(rows=party_rows[assignment == i]))
+    else:
+        for party, party_seed in zip(parties, np.random.SeedSequence(seed).spawn(len(parties))):
+            for name, split in split_party(party, fractions, party_seed, label_name).items():
+                splits[name].append(split)
+    return {name: Dataset(dataset.name, dataset.type, dataset.label_name, splits[name], dataset.options) for name in fractions}
@@ -0,0 +1,335 @@
+import io
+import os
+import json
+import hashlib
+import numpy as np
+from functools import partial
+from .dataset import Dataset, Party, LazyParties, pool_map, load_from_json, save_to_json, load_party_from_json, open_party_from_json, \
+    save_party_to_json
+from .columns import NUMERIC_DTYPES, VarColumn
+from .compression import CODECS, write_compressed, read_compressed
+
+FORMATS = ['columnar', 'json']
+COLUMNAR_VERSION = 1
+STATS_FILE = '_stats.npz'
+STATS_ARRAYS = ['min', 'max', 'mean', 'column_missing']
+ALIGNMENT_FILE = '_align.npz'
+
+
+def read_manifest(in_dir):
+    with open(os.path.join(in_dir, '_main.json'), 'r') as infile:
+        return json.load(infile)
+
+
+def files_meta(in_dir, paths):
+    # sizes and a combined sha256 of files, paths are relative to the dataset directory
+    sha256 = hashlib.sha256()
+    sizes = {}
+    for path in sorted(paths):
+        with open(os.path.join(in_dir, path), 'rb') as infile:
+            for chunk in iter(lambda: infile.read(1 << 20), b''):
+                sha256.update(chunk)
+        sizes[path] = os.path.getsize(os.path.join(in_dir, path))
+    return {'files': sizes, 'sha256': sha256.hexdigest()}
+
+
+def manifest_fingerprint(manifest):
+    content = {key: manifest[key] for key in ['name', 'type', 'label_name', 'parties', 'options']}
+    content['party_meta'] = [{'num_records': meta['num_records'], 'sha256': meta['sha256']} for meta in manifest['party_meta']]
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def write_stats(out_dir, party_meta):
+    # the per-column arrays of Party.stats are concatenated over all parties into _stats.npz (one value per column is
+    # too much for _main.json with wide parties like femnist), row counts, label histograms and missing counts stay in meta
+    arrays = {name: [] for name in STATS_ARRAYS}
+    for meta in party_meta:
+        for name in STATS_ARRAYS:
+            arrays[name].append(meta['stats'].pop(name))
+    np.savez(os.path.join(out_dir, STATS_FILE), **{name: np.concatenate(arrays[name]) if len(arrays[name]) > 0 else np.zeros(0)
+                                                     for name in STATS_ARRAYS})
+
+
+def read_stats(in_dir, manifest=None):
+    # {party.name: Party.stats} of a cache, None if it was written before statistics were recorded
+    if manifest is None:
+        manifest = read_manifest(in_dir)
+    if not os.path.exists(os.path.join(in_dir, STATS_FILE)) or 'party_meta' not in manifest or \
+            any('stats' not in meta for meta in manifest['party_meta']):
+        return None
+    with np.load(os.path.join(in_dir, STATS_FILE)) as infile:
+        arrays = {name: infile[name] for name in STATS_ARRAYS}
+    stats = {}
+    start = 0
+    for party_name, meta in zip(manifest['parties'], manifest['party_meta']):
+        stop = start+len(meta['column_name'])
+        stats[party_name] = dict(meta['stats'], **{name: arrays[name][start:stop] for name in STATS_ARRAYS})
+        start = stop
+    return stats
+
+
+def write_alignment(dataset, out_dir):
+    # vertical datasets with a unique_id get their Dataset.align result cached next to them, it is skipped (and computed on
+    # first use after loading) when a party is only given by name or does not have the id column, e.g. after select(columns)
+    unique_id = (dataset.options or {}).get('unique_id')
+    if dataset.type != 1 or unique_id is None:
+        return
+    if any(isinstance(party, str) or unique_id not in party.column_name for party in dataset.parties):
+        return
+    rows, size = dataset.align()
+    np.savez(os.path.join(out_dir, ALIGNMENT_FILE), size=np.array(size), **{'rows_'+str(i): party_rows for i, party_rows in enumerate(rows)})
+
+
+def read_alignment(in_dir, manifest):
+    if not os.path.exists(os.path.join(in_dir, ALIGNMENT_FILE)):
+        return None
+    with np.load(os.path.join(in_dir, ALIGNMENT_FILE)) as infile:
+        return [infile['rows_'+str(i)] for i in range(len(manifest['parties']))], int(infile['size'])
+
+
+def write_manifest(dataset, out_dir, format, party_meta):
+    write_stats(out_dir, party_meta)
+    write_alignment(dataset, out_dir)
+    manifest = json.loads(dataset.to_json())
+    manifest['format'] = format
+    if format == 'columnar':
+        manifest['version'] = COLUMNAR_VERSION
+    manifest['party_meta'] = party_meta
+    manifest['fingerprint'] = manifest_fingerprint(manifest)
+    with open(os.path.join(out_dir, '_main.json'), 'w') as outfile:
+        outfile.write(json.dumps(manifest, indent=4))
+
+
+def check_cache(in_dir, verify=False):
+    # decides from _main.json and file sizes alone whether a cache is complete, no party file is opened;
+    # verify also reads every party file and compares it with the sha256 recorded for it
+    manifest = read_manifest(in_dir)
+    if 'fingerprint' not in manifest:
+        # written before fingerprints were recorded, nothing to check
+        return manifest
+    if manifest['fingerprint'] != manifest_fingerprint(manifest) or len(manifest['party_meta']) != len(manifest['parties']):
+        raise RuntimeError('the cache in {} is incomplete or corrupted, please delete it and run again.'.format(in_dir))
+    for meta in manifest['party_meta']:
+        for path, size in meta['files'].items():
+            if not os.path.isfile(os.path.join(in_dir, path)) or os.path.getsize(os.path.join(in_dir, path)) != size:
+                raise RuntimeError('the cache in {} is incomplete or corrupted, please delete it and run again.'.format(in_dir))
+        if verify and files_meta(in_dir, meta['files'])['sha256'] != meta['sha256']:
+            raise RuntimeError('the cache in {} is incomplete or corrupted, please delete it and run again.'.format(in_dir))
+    return manifest
+
+
+def check_legacy_cache(in_dir):
+    # check_cache for caches written before completion markers existed, their files are verified; caches written before
+    # fingerprints were recorded have no checksums, a crash may have left their parties half-written, so they are only
+    # accepted if every party loads
+    manifest = check_cache(in_dir, verify=True)
+    if 'fingerprint' in manifest:
+        return manifest
+    try:
+        for party in load_dataset(in_dir).parties:
+            len(party.records)
+    except (OSError, ValueError, KeyError) as e:
+        raise RuntimeError('the cache in {} is incomplete or corrupted, please delete it and run again.'.format(in_dir)) from e
+    return manifest
+
+
+def column_blocks(dtypes):
+    # runs of numeric columns with the same dtype are stored together as one fortran-ordered (num_records, k) block,
+    # so a wide party like femnist (785 columns) is a couple of files rather than one file per column
+    blocks = []
+    start = 0
+    for j in range(1, len(dtypes)+1):
+        if j == len(dtypes) or dtypes[j] != dtypes[start] or dtypes[start] not in NUMERIC_DTYPES:
+            blocks.append((start, j))
+            start = j
+    return blocks
+
+
+DTYPE_NAMES = {np.dtype(dtype): dtype for dtype in NUMERIC_DTYPES}
+
+
+def column_dtype(column):
+    # dtype.name is slow enough to matter for parties with hundreds of columns
+    if isinstance(column, VarColumn):
+        return column.dtype
+    return DTYPE_NAMES.get(column.dtype) or column.dtype.name
+
+
+def save_npy(path, array, codec):
+    if codec is None:
+        np.save(path, array)
+        return
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    write_compressed(path+'.'+codec, buffer.getbuffer(), codec)
+
+
+def load_npy(path, codec):
+    # uncompressed arrays are memory-mapped read-only, so processes loading the same cache share the page cache
+    if codec is None:
+        return np.load(path, mmap_mode='r')
+    return np.load(io.BytesIO(read_compressed(path+'.'+codec, codec)))
+
+
+def save_bytes(path, data, codec):
+    if codec is None:
+        data.tofile(path)
+    else:
+        write_compressed(path+'.'+codec, np.ascontiguousarray(data), codec)
+
+
+def load_bytes(path, codec):
+    if codec is not None:
+        return np.frombuffer(read_compressed(path+'.'+codec, codec), dtype=np.uint8)
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+def save_block(columns, path, codec=None):
+    if isinstance(columns[0], VarColumn):
+        save_bytes(path+'.data', columns[0].data[columns[0].offsets[0]:columns[0].offsets[-1]], codec)
+        save_npy(path+'.offsets.npy', columns[0].offsets-columns[0].offsets[0], codec)
+        return
+    block = np.empty((len(columns[0]), len(columns)), dtype=columns[0].dtype, order='F')
+    for t, column in enumerate(columns):
+        block[:, t] = column
+    save_npy(path+'.npy', block, codec)
+
+
+def load_block(dtype, width, path, codec=None):
+    if dtype in NUMERIC_DTYPES:
+        block = load_npy(path+'.npy', codec)
+        return [block[:, t] for t in range(width)]
+    return [VarColumn(dtype, load_bytes(path+'.data', codec), load_npy(path+'.offsets.npy', codec))]
+
+
+def save_party(out_dir, codec, label_name, party):
+    party_dir = os.path.join(out_dir, party.name)
+    if not os.path.exists(party_dir):
+        os.makedirs(party_dir)
+    columns = party.to_columns()
+    # the columns are built once for the files and the statistics
+    party = Party(party.name, party.column_name, columns=columns)
+    dtypes = [column_dtype(column) for column in columns]
+    for start, stop in column_blocks(dtypes):
+        save_block(columns[start:stop], os.path.join(party_dir, str(start)), codec)
+    meta = {
+        'column_name': party.column_name,
+        'dtype': dtypes,
+        'num_records': len(party.records),
+        'codec': codec,
+        'stats': party.stats(label_name),
+    }
+    meta.update(files_meta(out_dir, [os.path.join(party.name, path) for path in os.listdir(party_dir)]))
+    return meta
+
+
+def json_party_meta(out_dir, label_name, party):
+    meta = {'column_name': party.column_name, 'num_records': len(party.records), 'stats': party.stats(label_name)}
+    meta.update(files_meta(out_dir, [party.name+'.json', party.name+'.index.npy']))
+    return meta
+
+
+def load_party(party_dir, party_name, meta, columns=None, rows=None):
+    # only blocks holding one of the requested columns are opened, rows are applied to the memory maps (see Party.select)
+    if columns is None:
+        indices = list(range(len(meta['column_name'])))
+    else:
+        indices = [meta['column_name'].index(name) for name in columns if name in meta['column_name']]
+    loaded = {}
+    for start, stop in column_blocks(meta['dtype']):
+        if any(start <= j < stop for j in indices):
+            block = load_block(meta['dtype'][start], stop-start, os.path.join(party_dir, str(start)), meta.get('codec'))
+            loaded.update(zip(range(start, stop), block))
+    party = Party(party_name, [meta['column_name'][j] for j in indices], columns=[loaded[j] for j in indices])
+    if rows is None:
+        return party
+    return party.select(rows=rows)
+
+
+def write_party(out_dir, format, codec, label_name, party):
+    # writes one party of a dataset that is saved party by party and returns its party_meta, write_manifest finishes the
+    # dataset once every party is written; the files are the same as those of save_dataset
+    if format == 'columnar':
+        return save_party(out_dir, codec, label_name, party)
+    if codec is not None:
+        raise NotImplementedError('Codec {} is only supported by the columnar format.'.format(codec))
+    save_party_to_json(out_dir, 4, party)
+    return json_party_meta(out_dir, label_name, party)
+
+
+def save_to_columnar(dataset, out_dir, workers=None, codec=None):
+    # codec: compress every block in independently decompressible chunks (gzip / zstd), compressed blocks are not memory-mapped
+    if codec is not None and codec not in CODECS:
+        raise NotImplementedError('Codec {} is not supported.'.format(codec))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    party_meta = pool_map(partial(save_party, out_dir, codec, dataset.label_name), dataset.parties, workers=workers)
+    write_manifest(dataset, out_dir, 'columnar', party_meta)
+
+
+def load_from_columnar(in_dir, lazy=False, max_resident=None, columns=None, rows=None):
+    if not os.path.exists(in_dir):
+        return None
+    manifest = read_manifest(in_dir)
+    if manifest.get('version', 0) > COLUMNAR_VERSION:
+        raise RuntimeError('the cache in {} was written by a newer version of flbenchmark, please upgrade.'.format(in_dir))
+    party_meta = dict(zip(manifest['parties'], manifest['party_meta']))
+
+    def loader(party_name):
+        return load_party(os.path.join(in_dir, party_name), party_name, party_meta[party_name], columns, rows)
+    if lazy:
+        parties = LazyParties(manifest['parties'], loader, max_resident)
+    else:
+        parties = [loader(party_name) for party_name in manifest['parties']]
+    if columns is not None or rows is not None:
+        return Dataset(manifest['name'], manifest['type'], manifest['label_name'], parties, manifest['options'])
+    return Dataset(manifest['name'], manifest['type'], manifest['label_name'], parties, manifest['options'],
+                   read_stats(in_dir, manifest), read_alignment(in_dir, manifest))
+
+
+def save_dataset(dataset, out_dir, format='columnar', workers=None, codec=None):
+    if format == 'columnar':
+        save_to_columnar(dataset, out_dir, workers, codec)
+    elif format == 'json':
+        if codec is not None:
+            raise NotImplementedError('Codec {} is only supported by the columnar format.'.format(codec))
+        save_to_json(dataset, out_dir, workers=workers)
+        # _main.json gets the same row counts and fingerprint as a columnar cache, json readers ignore the extra keys
+        write_manifest(dataset, out_dir, 'json', pool_map(partial(json_party_meta, out_dir, dataset.label_name), dataset.parties, workers=workers))
+    else:
+        raise NotImplementedError('Format {} is not supported.'.format(format))
+
+
+def save_splits(splits, out_dir, format='columnar', workers=None, codec=None):
+    # the {split name: Dataset} of Dataset.split as <out_dir>/train, <out_dir>/test, ... caches
+    for name, dataset in splits.items():
+        save_dataset(dataset, os.path.join(out_dir, name), format, workers, codec)
+
+
+def load_dataset(in_dir, lazy=False, max_resident=None, workers=None, columns=None, rows=None):
+    # the format is detected from _main.json, caches written before the columnar format existed are plain json
+    # columnar parties are memory maps and cheap to open, so workers only parallelizes json parsing
+    if not os.path.exists(in_dir):
+        return None
+    manifest = read_manifest(in_dir)
+    if manifest.get('format', 'json') == 'columnar':
+        return load_from_columnar(in_dir, lazy, max_resident, columns, rows)
+    dataset = load_from_json(in_dir, lazy, max_resident, workers, columns, rows)
+    if columns is None and rows is None:
+        dataset = Dataset(dataset.name, dataset.type, dataset.label_name, dataset.parties, dataset.options,
+                          read_stats(in_dir, manifest), read_alignment(in_dir, manifest))
+    return dataset
+
+
+def open_party(in_dir, party_name):
+    # random access to one party of a cache: get_record(i) / get_records(indices) read only the requested rows
+    manifest = read_manifest(in_dir)
+    meta = dict(zip(manifest['parties'], manifest.get('party_meta', [])))
+    if manifest.get('format', 'json') == 'columnar':
+        return load_party(os.path.join(in_dir, party_name), party_name, meta[party_name])
+    if os.path.exists(os.path.join(in_dir, party_name+'.index.npy')) and party_name in meta:
+        return open_party_from_json(in_dir, party_name, meta[party_name]['column_name'])
+    # json written before offset indexes existed
+    return load_party_from_json(in_dir, party_name)
@@ -1,11 +1,8 @@
 import os
-import pandas as pd
 import random
 import json
 import numpy as np
 
-random.seed(0)
-
 def convert_to_csv(dataset, out_dir):
     out_dir = os.path.expanduser(out_dir)
     if not os.path.exists(out_dir):
@@ -13,7 +10,9 @@ def convert_to_csv(dataset, out_dir):
     with open(os.path.join(out_dir, '_main.json'), 'w') as outfile:
         outfile.write(dataset.to_json())
     for party in dataset.parties:
-        df = pd.DataFrame(party.records, columns=party.column_name)
+        df = party.to_pandas()
+        # float32 columns are printed with the digits of the float64 values they were converted from
+        df = df.astype({name: np.float64 for name in df.columns if df[name].dtype == np.float32})
         df.to_csv(os.path.join(out_dir, party.name+'.csv'), index=False)
 
 class LibSvmDataset(object):
@@ -71,8 +70,7 @@ class LibSvmDataset(object):
     def getSamples(self, givenIdList):
         sampleList= []
         for id in givenIdList:
-            sample = self.get1Sample(id)
-            sample.insert(0, id) # add the id of sample 
+            sample = [id]+self.get1Sample(id) # add the id of sample, without changing the stored sample
             sampleList.append(sample)
         return sampleList
 
@@ -99,13 +97,14 @@ class Config(object):
     pass
 
 class LibSvmConverter(object):
-    def __init__(self, givenPathOfRawDataset,givenNameOfDataset):
+    def __init__(self, givenPathOfRawDataset,givenNameOfDataset, givenSeed=0):
         """
         - DESCRIPTION
 
         Given a libsvm dataset, split and convert it to '_main.json', 'train_main.json', and 'test_main.json' file.
         """
         self.__dataset = LibSvmDataset(givenFnPath=givenPathOfRawDataset, givenNameOfDataset=givenNameOfDataset)
+        self.__random = random.Random(givenSeed)
         self.__trainIdList = self.__getTrainIdList()
         self.__testIdList = self.__getTestIdList()
         pass
@@ -113,15 +112,13 @@ class LibSvmConverter(object):
     def __getTrainIdList(self):
         percentage = Config(givenTrainPercentage=0.8).getTrainPercentage()
         numberOfTrainSamples = int(self.__dataset.getNumberOfSamples() * percentage) 
-        trainIdList = random.sample(range(0, self.__dataset.getNumberOfSamples()), numberOfTrainSamples)
+        trainIdList = self.__random.sample(range(0, self.__dataset.getNumberOfSamples()), numberOfTrainSamples)
         return trainIdList
 
     def __getTestIdList(self):
-        testIdList = []
-        for id in range(0, self.__dataset.getNumberOfSamples()):
-            if id not in self.__trainIdList:
-                testIdList.append(id)
-        return testIdList
+        isTest = np.ones(self.__dataset.getNumberOfSamples(), dtype=bool)
+        isTest[self.__trainIdList] = False
+        return np.flatnonzero(isTest).tolist()
     
     def writeSamples2Json(self, givenIdListOfSamples, givenJsonPath):
         samples = self.__dataset.getSamples(givenIdList=givenIdListOfSamples)
@@ -180,7 +177,6 @@ class LibSvmConverter(object):
 
 def test():
     LibSvmConverter(givenPathOfRawDataset = "/home/yawei/Documents/libsvm/breast-cancer.txt", givenNameOfDataset="breast-cancer").execute()
-test()
 
 
 
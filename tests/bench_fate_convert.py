@@ -0,0 +1,45 @@
+# conversion time of every FATE_DATASETS entry, cell by cell (as download_convert_fate did before) against columns_from_pandas
+# usage: python bench_fate_convert.py [dataset ...] [--skip-cells]
+import sys
+import time
+import tempfile
+import pandas as pd
+import flbenchmark.datasets
+from flbenchmark.datasets.dataset import Dataset, Party
+from flbenchmark.datasets.columns import columns_from_pandas
+from flbenchmark.datasets.fate import FATE_DATA_URL, FATE_DATASETS
+
+
+def convert_cells(df):
+    n, m = df.shape
+    values = [[df.iat[i, j].item() for j in range(m)] for i in range(n)]
+    party = Party('p', df.columns.tolist(), values)
+    party.to_columns()
+    return party
+
+
+def bench(name, skip_cells):
+    party_names = sorted(set(party_name for dataset in FATE_DATASETS[name] if dataset is not None for party_name in dataset.parties))
+    for party_name in party_names:
+        df = pd.read_csv(FATE_DATA_URL+party_name+'.csv')
+        start = time.perf_counter()
+        party = Party(party_name, df.columns.tolist(), columns=columns_from_pandas(df))
+        columns_time = time.perf_counter()-start
+        with tempfile.TemporaryDirectory() as out_dir:
+            start = time.perf_counter()
+            flbenchmark.datasets.save_dataset(Dataset(name, 0, None, [party]), out_dir)
+            save_time = time.perf_counter()-start
+        cells_time = float('nan')
+        if not skip_cells:
+            start = time.perf_counter()
+            convert_cells(df)
+            cells_time = time.perf_counter()-start
+        print('{:<26} {:<32} {:>8} {:>4} {:>10.4f} {:>10.4f} {:>10.4f}'.format(name, party_name, df.shape[0], df.shape[1],
+                                                                            cells_time, columns_time, save_time))
+
+
+if __name__ == '__main__':
+    names = [arg for arg in sys.argv[1:] if not arg.startswith('--')] or list(FATE_DATASETS)
+    print('{:<26} {:<32} {:>8} {:>4} {:>10} {:>10} {:>10}'.format('dataset', 'party', 'rows', 'cols', 'cells (s)', 'columns (s)', 'save (s)'))
+    for name in names:
+        bench(name, '--skip-cells' in sys.argv)
@@ -0,0 +1,11 @@
+import pytest
+from flbenchmark.datasets.dataset import Dataset, Party
+
+
+@pytest.fixture
+def dataset():
+    parties = [
+        Party('guest', ['id', 'y', 'x0', 'x1'], [[0, 1, 0.5, 'a'], [1, 0, -1.25, 'bé']]),
+        Party('host', ['y', 'x0'], [[True, [[1, 2], 'c']], [False, {'k': None}], [True, 3.0]]),
+    ]
+    return Dataset('toy', 0, 'y', parties, {'unique_id': 'id'})
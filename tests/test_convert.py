@@ -0,0 +1,212 @@
+import json
+import base64
+import os
+import numpy as np
+from flbenchmark.datasets.cache import variant_dir, variant_key
+import flbenchmark.datasets
+from flbenchmark.datasets.leaf import LEAF_SOURCE_CODE_COMMIT, convert_leaf, iter_shard, read_user
+
+
+def make_leaf_dir(tmp_path, dataset, shards):
+    leaf_dir = str(tmp_path / 'leaf')
+    for split, user_data in shards.items():
+        split_dir = os.path.join(leaf_dir, 'data', dataset, 'data', split)
+        os.makedirs(split_dir)
+        users = sorted(user_data)
+        for i in range(0, len(users), 2):
+            shard_users = users[i:i+2]
+            with open(os.path.join(split_dir, 'shard_{}.json'.format(i)), 'w') as f:
+                json.dump({'users': shard_users, 'num_samples': [len(user_data[user]['y']) for user in shard_users],
+                           'user_data': {user: user_data[user] for user in shard_users}}, f)
+    return leaf_dir
+
+
+def synthetic_shards(num_users=5):
+    shards = {}
+    for split, num_records in [('train', 3), ('test', 2)]:
+        shards[split] = {'u{}'.format(u): {'x': [[u+0.5*i, -1.0*i] for i in range(num_records)], 'y': [i % 2 for i in range(num_records)]}
+                         for u in range(num_users)}
+    return shards
+
+
+def test_convert_leaf_workers(tmp_path):
+    leaf_dir = make_leaf_dir(tmp_path, 'synthetic', synthetic_shards())
+    serial = convert_leaf('synthetic', leaf_dir, '')
+    parallel = convert_leaf('synthetic', leaf_dir, '', workers=2)
+    assert len(serial) == len(parallel) == 2
+    for dataset, dataset_parallel in zip(serial, parallel):
+        assert dataset.to_json() == dataset_parallel.to_json()
+        assert [party.to_json() for party in dataset.parties] == [party.to_json() for party in dataset_parallel.parties]
+    assert [party.name for party in serial[0].parties] == ['u0', 'u1', 'u2', 'u3', 'u4']
+    assert serial[0].parties[1].records[2] == [0, 2.0, -2.0]
+
+
+def test_iter_shard(tmp_path):
+    user_data = {'u{}'.format(u): {'x': ['ab{}c"é['.format(u)*u, 12345678+u], 'y': [1.5e-7*u]} for u in range(20)}
+    path = str(tmp_path / 'shard.json')
+    with open(path, 'w') as f:
+        f.write(' { "users" : ["u0"], "hierarchies": [], "user_data" :'+json.dumps(user_data)+', "num_samples": [1] }\n')
+    for chunk_size in [3, 64, 1 << 20]:
+        users = list(iter_shard(path, chunk_size))
+        assert [user for user, _, _, _ in users] == list(user_data)
+        assert all(data == user_data[user] and read_user((path, start, end)) == data for user, start, end, data in users)
+
+
+def read_files(root):
+    files = {}
+    for dir_path, _, file_names in os.walk(root):
+        for file_name in file_names:
+            with open(os.path.join(dir_path, file_name), 'rb') as f:
+                files[os.path.relpath(os.path.join(dir_path, file_name), root)] = f.read()
+    return files
+
+
+def test_convert_leaf_streaming(tmp_path):
+    leaf_dir = make_leaf_dir(tmp_path, 'synthetic', synthetic_shards(11))
+    for format in ['columnar', 'json']:
+        streamed, saved = str(tmp_path / format / 'streamed'), str(tmp_path / format / 'saved')
+        assert convert_leaf('synthetic', leaf_dir, '', out_dirs=[os.path.join(streamed, 'train'), os.path.join(streamed, 'test')], format=format) is None
+        for split, dataset in zip(['train', 'test'], convert_leaf('synthetic', leaf_dir, '')):
+            flbenchmark.datasets.save_dataset(dataset, os.path.join(saved, split), format)
+        assert read_files(streamed) == read_files(saved)
+        parallel = str(tmp_path / format / 'parallel')
+        convert_leaf('synthetic', leaf_dir, '', workers=3, out_dirs=[os.path.join(parallel, 'train'), os.path.join(parallel, 'test')], format=format)
+        assert read_files(parallel) == read_files(saved)
+
+
+def test_leaf_variants(tmp_path, monkeypatch):
+    import flbenchmark.datasets.flbdatasets as flbdatasets
+    preprocessed = []
+    monkeypatch.setattr(flbdatasets, 'download_leaf', lambda leaf_dir, **kwargs: None)
+    monkeypatch.setattr(flbdatasets, 'preprocess_leaf', lambda dataset, leaf_dir, args: preprocessed.append(args))
+    leaf_dir = make_leaf_dir(tmp_path, 'synthetic', synthetic_shards())
+    flbd = flbdatasets.FLBDatasets(str(tmp_path / 'data'))
+    train_a, _ = flbd.leafDatasets('synthetic', leaf_dir=leaf_dir, leaf_args='-k 1', keep_leaf=True)
+    train_b, _ = flbd.leafDatasets('synthetic', leaf_dir=leaf_dir, leaf_args='-k 2', keep_leaf=True)
+    train_a_cached, _ = flbd.leafDatasets('synthetic', leaf_dir=leaf_dir, leaf_args='-k 1', keep_leaf=True)
+    assert preprocessed == ['-k 1', '-k 2']
+    assert train_a_cached.options == {'leaf_args': '-k 1'}
+    assert train_a.to_json() == train_a_cached.to_json()
+    assert len([entry for entry in (tmp_path / 'data' / '_variants').iterdir() if entry.is_dir()]) == 2
+    with open(str(tmp_path / 'data' / 'synthetic' / 'train' / '_main.json')) as f:
+        assert json.load(f)['options'] == {'leaf_args': '-k 1'}
+
+
+def test_leaf_cache_atomic(tmp_path, monkeypatch):
+    import flbenchmark.datasets.flbdatasets as flbdatasets
+    monkeypatch.setattr(flbdatasets, 'download_leaf', lambda leaf_dir, **kwargs: None)
+    monkeypatch.setattr(flbdatasets, 'preprocess_leaf', lambda dataset, leaf_dir, args: None)
+    leaf_dir = make_leaf_dir(tmp_path, 'synthetic', synthetic_shards())
+    flbd = flbdatasets.FLBDatasets(str(tmp_path / 'data'))
+    # a half-written directory without the completion marker is not mistaken for a cache
+    cache_dir = variant_dir(str(tmp_path / 'data'), 'synthetic', variant_key('synthetic', '-k 1', LEAF_SOURCE_CODE_COMMIT))
+    os.makedirs(os.path.join(cache_dir, 'train'))
+    os.makedirs(cache_dir+'.tmp-crashed')
+    train_dataset, _ = flbd.leafDatasets('synthetic', leaf_dir=leaf_dir, leaf_args='-k 1', keep_leaf=True)
+    assert len(train_dataset.parties) == 5
+    assert [entry.name for entry in (tmp_path / 'data' / '_variants').iterdir() if entry.is_dir()] == [os.path.basename(cache_dir)]
+    with open(str(tmp_path / 'data' / 'synthetic' / '_complete.json')) as f:
+        assert set(json.load(f)['fingerprints']) == {'train', 'test'}
+
+
+def test_convert_celeba_images(tmp_path):
+    from PIL import Image
+    from flbenchmark.datasets.leaf import read_image
+    from flbenchmark.datasets.storage import save_dataset as save
+    shards = {split: {'u{}'.format(u): {'x': ['{}_{}_{}.jpg'.format(split, u, i) for i in range(3)], 'y': [i % 2 for i in range(3)]}
+                      for u in range(2)} for split in ['train', 'test']}
+    leaf_dir = make_leaf_dir(tmp_path, 'celeba', shards)
+    image_dir = os.path.join(leaf_dir, 'data', 'celeba', 'data', 'raw', 'img_align_celeba')
+    os.makedirs(image_dir)
+    for user_data in shards.values():
+        for u, user in enumerate(sorted(user_data)):
+            for i, img_name in enumerate(user_data[user]['x']):
+                Image.new('RGB', (6, 8), (40*u, 20*i, 100)).save(os.path.join(image_dir, img_name))
+    train, _ = convert_leaf('celeba', leaf_dir, '')
+
+    def encode_image(img_name):
+        return base64.b64encode(read_image('celeba', leaf_dir, img_name)).decode('utf-8')
+    party = train.parties[1]
+    assert party.columns[1].dtype == 'image'
+    # records keep the base64 text they had before
+    assert party.records[2] == [0, encode_image('train_1_2.jpg')]
+    assert json.loads(party.to_json())['records'] == [[i % 2, encode_image('train_1_{}.jpg'.format(i))] for i in range(3)]
+    out_dir = str(tmp_path / 'celeba')
+    save(train, out_dir)
+    with open(os.path.join(out_dir, 'u1', '1.data'), 'rb') as f:
+        assert f.read() == b''.join(party.columns[1].raw(i) for i in range(3))
+    loaded = flbenchmark.datasets.open_party(out_dir, 'u1')
+    assert isinstance(loaded.columns[1].data, np.memmap)
+    assert loaded.get_records([2, 0]) == [party.records[2], party.records[0]]
+    tensor = flbenchmark.datasets.image_tensor(out_dir, 'u1', size=(4, 5))
+    assert tensor.shape == (3, 5, 4, 3) and tensor.dtype == np.uint8
+    assert isinstance(flbenchmark.datasets.image_tensor(out_dir, 'u1', size=(4, 5)), np.memmap)
+    assert np.abs(flbenchmark.datasets.decode_images(loaded.columns[1], [0])[0].astype(int)-[40, 0, 100]).max() < 8
+    # json caches hold base64 text, the same images are decoded from it
+    save(train, str(tmp_path / 'celeba_json'), 'json')
+    assert np.array_equal(flbenchmark.datasets.image_tensor(str(tmp_path / 'celeba_json'), 'u1', size=(4, 5)), tensor)
+
+
+def write_legacy_cache(dataset, out_dir):
+    # a cache as written before fingerprints and completion markers existed
+    flbenchmark.datasets.save_dataset(dataset, out_dir, 'json')
+    with open(os.path.join(out_dir, '_main.json')) as f:
+        manifest = json.load(f)
+    del manifest['fingerprint']
+    with open(os.path.join(out_dir, '_main.json'), 'w') as f:
+        json.dump(manifest, f)
+
+
+def test_fate_legacy_cache(tmp_path, monkeypatch):
+    import flbenchmark.datasets.flbdatasets as flbdatasets
+    from flbenchmark.datasets.dataset import Dataset, Party
+    dataset = Dataset('toy', 1, 'y', [Party('guest', ['id', 'y'], [[0, 1], [1, 0]])], {'unique_id': 'id'})
+    test_dataset = Dataset('toy_split', 1, 'y', [Party('guest', ['id', 'y'], [[2, 1]])], {'unique_id': 'id'})
+    monkeypatch.setitem(flbdatasets.FATE_DATASETS, 'toy', [dataset, None])
+    monkeypatch.setitem(flbdatasets.FATE_DATASETS, 'toy_split', [dataset, test_dataset])
+    monkeypatch.setattr(flbdatasets, 'download_convert_fate', lambda name, source: (dataset, test_dataset if name == 'toy_split' else None))
+    flbd = flbdatasets.FLBDatasets(str(tmp_path / 'data'))
+    # left half-written by a crash
+    train_dir = str(tmp_path / 'data' / 'toy' / 'train')
+    write_legacy_cache(dataset, train_dir)
+    with open(os.path.join(train_dir, 'guest.json'), 'r+') as f:
+        f.truncate(10)
+    train_dataset, _ = flbd.fateDatasets('toy')
+    assert list(train_dataset.parties[0].records) == [[0, 1], [1, 0]]
+    assert list(flbd.fateDatasets('toy')[0].parties[0].records) == [[0, 1], [1, 0]]
+    # the crash came after train but before test was written
+    write_legacy_cache(dataset, str(tmp_path / 'data' / 'toy_split' / 'train'))
+    assert list(flbd.fateDatasets('toy_split')[1].parties[0].records) == [[2, 1]]
+    assert list(flbd.fateDatasets('toy_split')[1].parties[0].records) == [[2, 1]]
+    # a split that changed after the marker was written makes the cache incomplete
+    with open(os.path.join(train_dir, '_main.json')) as f:
+        manifest = json.load(f)
+    manifest['fingerprint'] = '0'*64
+    with open(os.path.join(train_dir, '_main.json'), 'w') as f:
+        json.dump(manifest, f)
+    assert not flbdatasets.is_complete(str(tmp_path / 'data' / 'toy'))
+
+
+def test_evict_variants_concurrent(tmp_path, monkeypatch):
+    import shutil
+    from contextlib import contextmanager
+    import flbenchmark.datasets.cache as cache
+    for name in ['a', 'b']:
+        path = variant_dir(str(tmp_path), 'synthetic', name)
+        os.makedirs(os.path.join(path, 'train'))
+        with open(os.path.join(path, 'train', 'data'), 'wb') as f:
+            f.write(b'0'*100)
+        with open(os.path.join(path, 'train', '_main.json'), 'w') as f:
+            json.dump({'fingerprint': None}, f)
+        cache.mark_complete(path, ['train'])
+    cache_lock = cache.cache_lock
+
+    @contextmanager
+    def racing_lock(path):
+        # another launch removes the same variant while this one waits for its lock
+        shutil.rmtree(path, ignore_errors=True)
+        with cache_lock(path):
+            yield
+    monkeypatch.setattr(cache, 'cache_lock', racing_lock)
+    cache.evict_variants(str(tmp_path), 0)
+    assert [entry for entry in os.listdir(str(tmp_path / '_variants')) if not entry.endswith('.lock')] == []
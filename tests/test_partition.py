@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import flbenchmark.datasets
+from flbenchmark.datasets.dataset import Dataset, Party
+
+
+def make_horizontal(num_records=1000):
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, 4, num_records)
+    parties = [Party('guest', ['id', 'y', 'x0'], columns=[np.arange(0, num_records//2), labels[:num_records//2], rng.random(num_records//2)]),
+               Party('host', ['id', 'y', 'x0'], columns=[np.arange(num_records//2, num_records), labels[num_records//2:], rng.random(num_records-num_records//2)])]
+    return Dataset('toy', 0, 'y', parties, {'unique_id': 'id'})
+
+
+@pytest.mark.parametrize('method', ['iid', 'dirichlet', 'quantity'])
+def test_partition_rows(tmp_path, method):
+    dataset = make_horizontal()
+    partitioned = dataset.partition(10, method, alpha=0.3, seed=1)
+    assert len(partitioned.parties) == 10 and partitioned.options['partition']['method'] == method
+    ids = np.concatenate([party.to_columns()[0] for party in partitioned.parties])
+    assert sorted(ids.tolist()) == list(range(1000))
+    if method == 'iid':
+        assert [len(party.records) for party in partitioned.parties] == [100]*10
+    # rows keep their label
+    labels = np.concatenate([party.to_columns()[1] for party in partitioned.parties])
+    expected = np.concatenate([party.to_columns()[1] for party in dataset.parties])
+    assert (expected[ids] == labels).all()
+    again = dataset.partition(10, method, alpha=0.3, seed=1)
+    assert all(list(party.records) == list(other.records) for party, other in zip(partitioned.parties, again.parties))
+    flbenchmark.datasets.save_dataset(partitioned, str(tmp_path / 'train'))
+    loaded = flbenchmark.datasets.load_dataset(str(tmp_path / 'train'))
+    assert [list(party.records) for party in loaded.parties] == [list(party.records) for party in partitioned.parties]
+
+
+def test_partition_features():
+    dataset = Dataset('toy', 1, 'y', [Party('guest', ['id', 'y', 'x0', 'x1'], [[0, 1, 0.5, 1.5], [1, 0, 2.5, 3.5]]),
+                                      Party('host', ['id', 'x2', 'x3', 'x4'], [[0, 1, 2, 3], [1, 4, 5, 6]])], {'unique_id': 'id'})
+    partitioned = dataset.partition(3, 'feature')
+    assert [party.column_name for party in partitioned.parties] == [['id', 'y', 'x0', 'x1'], ['id', 'x2', 'x3'], ['id', 'x4']]
+    assert list(partitioned.parties[1].records) == [[0, 1, 2], [1, 4, 5]]
+    with pytest.raises(NotImplementedError):
+        dataset.partition(3, 'round_robin')
+
+
+def test_partition_features_unaligned():
+    # the host has the same ids in another order and one id the guest does not have
+    dataset = Dataset('toy', 1, 'y', [Party('guest', ['id', 'y', 'x0'], [[1, 0, 10.0], [2, 1, 20.0], [3, 0, 30.0]]),
+                                      Party('host', ['id', 'x1'], [[3, 300.0], [4, 400.0], [1, 100.0], [2, 200.0]])], {'unique_id': 'id'})
+    partitioned = dataset.partition(2, 'feature')
+    assert list(partitioned.parties[0].records) == [[1, 0, 10.0], [2, 1, 20.0], [3, 0, 30.0]]
+    assert list(partitioned.parties[1].records) == [[1, 100.0], [2, 200.0], [3, 300.0]]
+    with pytest.raises(RuntimeError):
+        Dataset('toy', 1, 'y', dataset.parties).partition(2, 'feature')
@@ -0,0 +1,19 @@
+import numpy as np
+import flbenchmark.datasets
+from flbenchmark.datasets.dataset import Dataset, Party
+
+
+def test_client_schedule(tmp_path):
+    schedule = flbenchmark.datasets.client_schedule(50, 300, 5, seed=3)
+    assert schedule.shape == (300, 5) and schedule.dtype.name == 'int32'
+    assert (flbenchmark.datasets.client_schedule(50, 300, 5, seed=3) == schedule).all()
+    assert all(len(set(row)) == 5 for row in schedule.tolist())
+    weighted = flbenchmark.datasets.client_schedule(4, 1000, 1, seed=0, weights=[0, 1, 1, 8])
+    counts = np.bincount(weighted[:, 0], minlength=4)
+    assert counts[0] == 0 and counts[3] > 3*counts[1]
+    dataset = Dataset('toy', 0, 'y', [Party('guest', ['y', 'x0'], [[0, 0.5], [1, 1.5]]), Party('host', ['y', 'x0'], [[1, 2.5], [0, 3.5], [1, 4.5]])])
+    flbenchmark.datasets.save_dataset(dataset, str(tmp_path / 'train'))
+    schedule = flbenchmark.datasets.dataset_schedule(str(tmp_path / 'train'), 10, 3, weighted=True)
+    assert schedule.tolist() == [[0, 1]]*10
+    flbenchmark.datasets.save_schedule(str(tmp_path / 'schedule.npy'), schedule)
+    assert (flbenchmark.datasets.load_schedule(str(tmp_path / 'schedule.npy')) == schedule).all()
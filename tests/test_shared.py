@@ -0,0 +1,23 @@
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+import flbenchmark.datasets
+
+
+def read_shared_party(name, party_name):
+    shared = flbenchmark.datasets.attach_dataset(name)
+    party = shared.dataset.get_party(party_name)
+    records = list(party.records)
+    shared.close()
+    return records
+
+
+def test_shared_dataset(dataset):
+    with flbenchmark.datasets.publish_dataset(dataset) as shared:
+        assert shared.dataset.to_json() == dataset.to_json()
+        assert [list(party.records) for party in shared.dataset.parties] == [list(party.records) for party in dataset.parties]
+        with pytest.raises(ValueError):
+            shared.dataset.parties[0].to_columns()[0][0] = 1
+        with ProcessPoolExecutor(2) as pool:
+            assert list(pool.map(read_shared_party, [shared.name]*2, ['guest', 'host'])) == \
+                [list(party.records) for party in dataset.parties]
+        assert list(shared.dataset.parties[1].records) == list(dataset.parties[1].records)
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tarfile
+import hashlib
+import threading
+import functools
+import http.server
+import pytest
+from flbenchmark.datasets.sources import DataSource
+from flbenchmark.datasets.fate import download_convert_fate
+from flbenchmark.datasets.leaf import fetch_raw_data, restore_raw_data, raw_data_dir
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / 'remote'
+    root.mkdir()
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(root))
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield root, 'http://127.0.0.1:{}/'.format(httpd.server_address[1])
+    httpd.shutdown()
+
+
+def test_fetch_cached(tmp_path, server):
+    root, url = server
+    (root / 'a.csv').write_text('x,y\n1,2\n')
+    source = DataSource(url, str(tmp_path / '_raw'))
+    path = source.fetch('a.csv')
+    assert open(path).read() == 'x,y\n1,2\n'
+    (root / 'a.csv').unlink()
+    checksum = hashlib.sha256(b'x,y\n1,2\n').hexdigest()
+    assert source.fetch_all(['a.csv', 'a.csv'], {'a.csv': checksum}) == [path, path]
+    (root / 'b.csv').write_text('1')
+    with pytest.raises(RuntimeError):
+        source.fetch('b.csv', checksum)
+
+
+def test_fetch_pinned(tmp_path, server):
+    root, url = server
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    (root / 'a.csv').write_text('x,y\n1,2\n')
+    (mirror / 'a.csv').write_text('x,y\n1,3\n')
+    raw_dir = str(tmp_path / '_raw')
+    DataSource(url, raw_dir, pins='fate').fetch('a.csv')
+    # the mirror serves other content than the file fetched first
+    with pytest.raises(RuntimeError):
+        DataSource(str(mirror), raw_dir, pins='fate').fetch('a.csv')
+    (mirror / 'a.csv').write_text('x,y\n1,2\n')
+    assert open(DataSource(str(mirror), raw_dir, pins='fate').fetch('a.csv')).read() == 'x,y\n1,2\n'
+    # other pins and explicit checksums are not affected
+    (mirror / 'a.csv').write_text('x,y\n1,3\n')
+    DataSource(str(mirror), raw_dir, pins='leaf').fetch('a.csv')
+    DataSource(str(mirror), raw_dir, pins='fate').fetch('a.csv', hashlib.sha256(b'x,y\n1,3\n').hexdigest())
+
+
+def test_fate_from_mirror(tmp_path):
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    (mirror / 'breast_hetero_guest.csv').write_text('id,y,x0\n0,1,0.5\n1,0,1.5\n')
+    (mirror / 'breast_hetero_host.csv').write_text('id,x1\n1,3\n0,4\n')
+    checksums = {path.name: hashlib.sha256(path.read_bytes()).hexdigest() for path in mirror.iterdir()}
+    train_dataset, test_dataset = download_convert_fate('breast_vertical', DataSource('file://'+str(mirror)), checksums)
+    assert test_dataset is None
+    assert [list(party.records) for party in train_dataset.parties] == [[[0, 1, 0.5], [1, 0, 1.5]], [[1, 3], [0, 4]]]
+    # a mirror with other content than the pinned files is rejected
+    (mirror / 'breast_hetero_host.csv').write_text('id,x1\n1,3\n0,5\n')
+    with pytest.raises(RuntimeError):
+        download_convert_fate('breast_vertical', DataSource('file://'+str(mirror)), checksums)
+
+
+def test_leaf_raw_data_from_mirror(tmp_path, server):
+    mirror = tmp_path / 'mirror'
+    (mirror / 'leaf-data' / 'femnist').mkdir(parents=True)
+    (mirror / 'leaf-data' / 'femnist' / 'by_class.zip').write_bytes(b'femnist')
+    fetch_raw_data('femnist', str(mirror), str(tmp_path / 'raw'))
+    leaf_dir = str(tmp_path / 'leaf')
+    restore_raw_data('femnist', leaf_dir, str(tmp_path / 'raw'))
+    with open(os.path.join(raw_data_dir('femnist', leaf_dir), 'by_class.zip'), 'rb') as f:
+        assert f.read() == b'femnist'
+    # remote mirrors serve a tarball of the directory, datasets the mirror does not have are left to preprocess.sh
+    root, url = server
+    (root / 'leaf-data').mkdir()
+    with tarfile.open(str(root / 'leaf-data' / 'sent140.tar.gz'), 'w:gz') as tar:
+        tar.add(str(mirror / 'leaf-data' / 'femnist' / 'by_class.zip'), 'training.csv')
+    fetch_raw_data('sent140', url, str(tmp_path / 'raw'))
+    fetch_raw_data('shakespeare', url, str(tmp_path / 'raw'))
+    assert sorted(os.listdir(str(tmp_path / 'raw' / 'leaf-data'))) == ['femnist', 'sent140']
+    assert (tmp_path / 'raw' / 'leaf-data' / 'sent140' / 'training.csv').read_bytes() == b'femnist'
+    # the raw data is taken again after the cached copy is gone, from a mirror whose files have changed since
+    shutil.rmtree(str(tmp_path / 'raw' / 'leaf-data' / 'femnist'))
+    (mirror / 'leaf-data' / 'femnist' / 'by_class.zip').write_bytes(b'femnist!')
+    with pytest.raises(RuntimeError):
+        fetch_raw_data('femnist', str(mirror), str(tmp_path / 'raw'))
@@ -0,0 +1,39 @@
+import numpy as np
+import flbenchmark.datasets
+from flbenchmark.datasets.dataset import Dataset, Party
+
+
+def make_party(name, num_records, seed):
+    rng = np.random.default_rng(seed)
+    return Party(name, ['id', 'y', 'x0'], columns=[np.arange(num_records), (rng.random(num_records) < 0.2).astype(np.int8), rng.random(num_records)])
+
+
+def test_split_stratified(tmp_path):
+    dataset = Dataset('toy', 0, 'y', [make_party('guest', 1000, 0), make_party('host', 501, 1)])
+    splits = dataset.split({'train': 0.7, 'test': 0.2, 'val': 0.1}, seed=0)
+    assert list(splits) == ['train', 'test', 'val']
+    for j, party in enumerate(dataset.parties):
+        parts = [splits[name].parties[j] for name in splits]
+        ids = np.concatenate([part.to_columns()[0] for part in parts])
+        assert sorted(ids.tolist()) == list(range(len(party.records)))
+        assert all((np.diff(part.to_columns()[0]) > 0).all() for part in parts)
+        positive = party.to_columns()[1].mean()
+        assert abs(parts[0].to_columns()[1].mean()-positive) < 0.01 and abs(parts[1].to_columns()[1].mean()-positive) < 0.02
+    assert [len(party.records) for party in splits['train'].parties] == [700, 351]
+    again = dataset.split({'train': 0.7, 'test': 0.2, 'val': 0.1}, seed=0)
+    assert (again['test'].parties[1].to_columns()[0] == splits['test'].parties[1].to_columns()[0]).all()
+    flbenchmark.datasets.save_splits(splits, str(tmp_path))
+    for name in splits:
+        loaded = flbenchmark.datasets.load_dataset(str(tmp_path / name))
+        assert [list(party.records) for party in loaded.parties] == [list(party.records) for party in splits[name].parties]
+
+
+def test_split_vertical():
+    guest = Party('guest', ['id', 'y'], [[i, i % 2] for i in range(10)])
+    host = Party('host', ['id', 'x0'], [[9-i, i*0.5] for i in range(12)])
+    splits = Dataset('toy', 1, 'y', [guest, host], {'unique_id': 'id'}).split(seed=1, stratify=False)
+    for dataset in splits.values():
+        assert [row[0] for row in dataset.parties[0].records] == [row[0] for row in dataset.parties[1].records]
+    assert [len(dataset.parties[0].records) for dataset in splits.values()] == [8, 2]
+    party_splits = guest.split({'a': 0.5, 'b': 0.5}, seed=0, label_name='y')
+    assert [sum(row[1] for row in part.records) for part in party_splits.values()] == [2, 3]
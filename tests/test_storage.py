@@ -0,0 +1,255 @@
+import io
+import os
+import json
+import pytest
+import flbenchmark.datasets
+from flbenchmark.datasets.dataset import Dataset, Party
+from flbenchmark.datasets.columns import columns_from_pandas
+
+
+def test_columnar_roundtrip(tmp_path, dataset):
+    flbenchmark.datasets.save_dataset(dataset, str(tmp_path / 'train'))
+    dataset_cached = flbenchmark.datasets.load_dataset(str(tmp_path / 'train'))
+    assert dataset.to_json() == dataset_cached.to_json()
+    assert [party.to_json() for party in dataset.parties] == [party.to_json() for party in dataset_cached.parties]
+
+
+def test_var_column_index():
+    from flbenchmark.datasets.columns import encode_column
+    column = encode_column(['a', 'bb', 'ccc'], 'str')
+    assert [column[-1], column[-3], column[1]] == ['ccc', 'a', 'bb']
+    assert column.raw(-2) == b'bb'
+    with pytest.raises(IndexError):
+        column[3]
+    with pytest.raises(IndexError):
+        column[-4]
+    assert column.take([-1, 0]).tolist() == ['ccc', 'a']
+    for indices in [[-5], [3], [0, 7]]:
+        with pytest.raises(IndexError):
+            column.take(indices)
+
+
+def test_json_export(tmp_path, dataset):
+    flbenchmark.datasets.save_dataset(dataset, str(tmp_path / 'train'), 'json')
+    dataset_cached = flbenchmark.datasets.load_dataset(str(tmp_path / 'train'))
+    assert dataset.to_json() == dataset_cached.to_json()
+    assert [party.to_json() for party in dataset.parties] == [party.to_json() for party in dataset_cached.parties]
+
+
+def test_columnar_records_view(tmp_path, dataset):
+    flbenchmark.datasets.save_dataset(dataset, str(tmp_path / 'train'))
+    party = flbenchmark.datasets.load_dataset(str(tmp_path / 'train')).parties[0]
+    assert len(party.records) == 2
+    assert party.records[1] == [1, 0, -1.25, 'bé']
+    assert party.records[-1] == party.records[1]
+    assert list(party.records[:1]) == [[0, 1, 0.5, 'a']]
+    assert [record for record in party.records] == dataset.parties[0].records
+    assert party.to_dict() == {'name': 'guest', 'column_name': ['id', 'y', 'x0', 'x1'], 'records': dataset.parties[0].records}
+    party.records = party.records[1:]
+    assert party.to_json() == Party('guest', ['id', 'y', 'x0', 'x1'], [[1, 0, -1.25, 'bé']]).to_json()
+
+
+def test_streaming_json_writer(dataset):
+    for party in dataset.parties:
+        expected = json.dumps({'name': party.name, 'column_name': party.column_name, 'records': party.records}, indent=4)
+        outfile = io.StringIO()
+        party.dump_json(outfile, chunk_size=8)
+        assert outfile.getvalue() == party.to_json() == expected
+        assert json.loads(party.to_json(indent=None)) == json.loads(expected)
+
+
+def test_lazy_parties(tmp_path, dataset):
+    for format in ['columnar', 'json']:
+        flbenchmark.datasets.save_dataset(dataset, str(tmp_path / format), format)
+        dataset_cached = flbenchmark.datasets.load_dataset(str(tmp_path / format), lazy=True, max_resident=1)
+        assert len(dataset_cached.parties.resident) == 0
+        assert dataset_cached.to_json() == dataset.to_json()
+        assert dataset_cached.get_party('host').to_json() == dataset.parties[1].to_json()
+        assert dataset_cached.parties[0].to_json() == dataset.parties[0].to_json()
+        assert list(dataset_cached.parties.resident) == ['guest']
+
+
+def test_parallel_save_load(tmp_path, dataset):
+    for format in ['columnar', 'json']:
+        flbenchmark.datasets.save_dataset(dataset, str(tmp_path / format), format, workers=2)
+        dataset_cached = flbenchmark.datasets.load_dataset(str(tmp_path / format), workers=2)
+        assert dataset.to_json() == dataset_cached.to_json()
+        assert [party.to_json() for party in dataset.parties] == [party.to_json() for party in dataset_cached.parties]
+
+
+def test_check_cache(tmp_path, dataset):
+    for format in ['columnar', 'json']:
+        flbenchmark.datasets.save_dataset(dataset, str(tmp_path / format), format)
+        manifest = flbenchmark.datasets.check_cache(str(tmp_path / format))
+        assert manifest['options'] == {'unique_id': 'id'}
+        assert [meta['num_records'] for meta in manifest['party_meta']] == [2, 3]
+        if format == 'columnar':
+            assert manifest['party_meta'][0]['dtype'] == ['int8', 'int8', 'float32', 'str']
+            assert manifest['party_meta'][1]['dtype'] == ['bool', 'json']
+        path = next(iter(manifest['party_meta'][1]['files']))
+        flbenchmark.datasets.check_cache(str(tmp_path / format), verify=True)
+        # a changed byte keeps the size, only verify notices it
+        with open(str(tmp_path / format / path), 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(b'\x00' if last != b'\x00' else b'\x01')
+        flbenchmark.datasets.check_cache(str(tmp_path / format))
+        with pytest.raises(RuntimeError):
+            flbenchmark.datasets.check_cache(str(tmp_path / format), verify=True)
+        with open(str(tmp_path / format / path), 'ab') as f:
+            f.write(b' ')
+        with pytest.raises(RuntimeError):
+            flbenchmark.datasets.check_cache(str(tmp_path / format))
+
+
+def test_compressed_columnar(tmp_path, dataset):
+    flbenchmark.datasets.save_dataset(dataset, str(tmp_path / 'train'), codec='gzip')
+    assert all(path.endswith('.gzip') for path in os.listdir(str(tmp_path / 'train' / 'guest')))
+    dataset_cached = flbenchmark.datasets.load_dataset(str(tmp_path / 'train'))
+    assert [party.to_json() for party in dataset.parties] == [party.to_json() for party in dataset_cached.parties]
+
+
+def test_select_pushdown(tmp_path, dataset):
+    guest = [[1, 0.5, 0], [0, -1.25, 1]]
+    host = [[True, [[1, 2], 'c']], [False, {'k': None}], [True, 3.0]]
+    cases = [(None, guest, host), (range(1, 2), guest[1:], host[1:2]), ([1, 0], guest[::-1], host[1::-1]),
+             (range(1, -1, -1), guest[::-1], host[1::-1]), (range(-1, 0), guest[1:], host[2:])]
+    for format in ['columnar', 'json']:
+        flbenchmark.datasets.save_dataset(dataset, str(tmp_path / format), format)
+        for rows, guest_records, host_records in cases:
+            dataset_cached = flbenchmark.datasets.load_dataset(str(tmp_path / format), columns=['y', 'x0', 'id'], rows=rows)
+            assert [party.column_name for party in dataset_cached.parties] == [['y', 'x0', 'id'], ['y', 'x0']]
+            assert [list(party.records) for party in dataset_cached.parties] == [guest_records, host_records]
+            dataset_selected = dataset_cached.select(rows=range(len(guest_records)-1, -1, -1))
+            assert [list(party.records) for party in dataset_selected.parties][0] == guest_records[::-1]
+    for rows, guest_records, host_records in cases:
+        assert [list(party.records) for party in dataset.select(['y', 'x0', 'id'], rows).parties] == [guest_records, host_records]
+
+
+def test_open_party_random_access(tmp_path, dataset):
+    for format in ['columnar', 'json']:
+        flbenchmark.datasets.save_dataset(dataset, str(tmp_path / format), format)
+        party = flbenchmark.datasets.open_party(str(tmp_path / format), 'host')
+        assert len(party.records) == 3
+        assert party.get_record(1) == [False, {'k': None}]
+        assert party.get_records([2, 0]) == [[True, 3.0], [True, [[1, 2], 'c']]]
+        assert party.to_json() == dataset.parties[1].to_json()
+
+
+def test_iter_batches(tmp_path):
+    dataset = Dataset('toy', 0, 'y', [Party('p', ['x0', 'y', 'x1'], [[i, i % 2, i*0.5] for i in range(10)])])
+    flbenchmark.datasets.save_dataset(dataset, str(tmp_path / 'train'))
+    for party_dataset in [dataset, flbenchmark.datasets.load_dataset(str(tmp_path / 'train'))]:
+        batches = list(party_dataset.iter_batches('p', 4))
+        assert [features.shape for features, _ in batches] == [(4, 2), (4, 2), (2, 2)]
+        assert batches[1][0].tolist() == [[4.0, 2.0], [5.0, 2.5], [6.0, 3.0], [7.0, 3.5]]
+        assert batches[2][1].tolist() == [0, 1]
+        shuffled = list(party_dataset.iter_batches('p', 4, shuffle=True, seed=1, drop_last=True))
+        assert len(shuffled) == 2
+        assert [features.tolist() for features, _ in shuffled] == \
+            [features.tolist() for features, _ in party_dataset.iter_batches('p', 4, shuffle=True, seed=1, drop_last=True)]
+        assert sorted(int(x) for features, _ in shuffled for x in features[:, 0]) != list(range(8))
+
+
+def test_prefetch_stopped_consumer():
+    import time
+    import threading
+    from flbenchmark.datasets.dataset import prefetch
+    produced = threading.Event()
+
+    def generator():
+        yield 0
+        yield 1
+        produced.set()
+        raise ValueError('the producer fails after the consumer stopped')
+    threads = threading.active_count()
+    batches = prefetch(generator())
+    assert next(batches) == 0
+    assert produced.wait(5)
+    batches.close()
+    # the producer thread exits instead of blocking on the full queue
+    for _ in range(50):
+        if threading.active_count() == threads:
+            break
+        time.sleep(0.1)
+    assert threading.active_count() == threads
+    with pytest.raises(ValueError):
+        list(prefetch(generator()))
+
+
+def test_numpy_pandas_views(tmp_path, dataset):
+    numeric = Dataset('toy', 0, 'y', [Party('p', ['x0', 'y', 'x1'], [[i*0.25, i % 2*1.0, i*0.5] for i in range(6)])])
+    flbenchmark.datasets.save_dataset(numeric, str(tmp_path / 'train'))
+    party = flbenchmark.datasets.load_dataset(str(tmp_path / 'train')).parties[0]
+    matrix = party.to_numpy()
+    assert matrix.shape == (6, 3) and not matrix.flags.writeable
+    assert matrix.tolist() == numeric.parties[0].to_numpy().tolist()
+    features, labels = party.to_numpy('y')
+    assert features.tolist() == [[i*0.25, i*0.5] for i in range(6)] and labels.tolist() == [i % 2 for i in range(6)]
+    frame = party.to_pandas()
+    assert list(frame.columns) == ['x0', 'y', 'x1']
+    assert frame.to_numpy().tolist() == matrix.tolist()
+    host = dataset.parties[1].to_pandas()
+    assert host['x0'].tolist() == [[[1, 2], 'c'], {'k': None}, 3.0]
+
+
+def test_float_blocks(tmp_path):
+    # femnist-like pixels: a white border that fits float32 around values that do not
+    pixels = [[1.0 if j % 28 in [0, 27] else 1-(i+j) % 7/255 for j in range(56)] for i in range(5)]
+    dataset = Dataset('toy', 0, 'y', [Party('p', ['y']+['x'+str(j) for j in range(56)], [[i % 2]+pixels[i] for i in range(5)])])
+    flbenchmark.datasets.save_dataset(dataset, str(tmp_path / 'train'))
+    manifest = flbenchmark.datasets.check_cache(str(tmp_path / 'train'))
+    assert set(manifest['party_meta'][0]['dtype'][1:]) == {'float64'}
+    assert sorted(manifest['party_meta'][0]['files']) == ['p/0.npy', 'p/1.npy']
+    features, _ = flbenchmark.datasets.load_dataset(str(tmp_path / 'train')).to_numpy('p')
+    assert not features.flags.writeable and features.tolist() == pixels
+
+
+def test_stats(tmp_path):
+    dataset = Dataset('toy', 0, 'y', [Party('a', ['y', 'x0', 'x1'], [[1, 0.5, 'u'], [0, float('nan'), 'v'], [1, 2.5, 'w']]),
+                                      Party('b', ['y', 'x0', 'x1'], [[0, 1.0, None]])])
+    for format in ['columnar', 'json']:
+        flbenchmark.datasets.save_dataset(dataset, str(tmp_path / format), format)
+        for stats in [flbenchmark.datasets.load_dataset(str(tmp_path / format)).stats, dataset.stats]:
+            assert stats['a']['num_records'] == 3 and stats['b']['num_records'] == 1
+            assert stats['a']['label_counts'] == {'0': 1, '1': 2}
+            assert stats['a']['min'][1] == 0.5 and stats['a']['max'][1] == 2.5 and stats['a']['mean'][1] == 1.5
+            assert stats['a']['column_missing'].tolist() == [0, 1, 0] and stats['b']['column_missing'].tolist() == [0, 0, 1]
+            assert stats['b']['missing'] == 1
+        with open(str(tmp_path / format / '_main.json')) as infile:
+            assert json.load(infile)['party_meta'][0]['stats'] == {'num_records': 3, 'label_counts': {'0': 1, '1': 2}, 'missing': 1}
+
+
+def test_align(tmp_path):
+    guest = Party('guest', ['id', 'y', 'x0'], [[5, 1, 0.5], [3, 0, 1.5], [9, 1, 2.5], [1, 0, 3.5]])
+    host = Party('host', ['id', 'x1'], [[1, 'a'], [2, 'b'], [3, 'c'], [5, 'd'], [5, 'e']])
+    dataset = Dataset('toy', 1, 'y', [guest, host], {'unique_id': 'id'})
+    rows, size = dataset.align()
+    assert size == 3
+    assert [party_rows.tolist() for party_rows in rows] == [[0, 1, 3], [3, 2, 0]]
+    for format in ['columnar', 'json']:
+        flbenchmark.datasets.save_dataset(dataset, str(tmp_path / format), format)
+        assert os.path.exists(str(tmp_path / format / '_align.npz'))
+        rows, size = flbenchmark.datasets.load_dataset(str(tmp_path / format)).align()
+        assert size == 3 and [party_rows.tolist() for party_rows in rows] == [[0, 1, 3], [3, 2, 0]]
+    with pytest.raises(RuntimeError):
+        Dataset('toy', 0, 'y', [host]).align()
+    # without the id column there is nothing to align by, the dataset is still saved
+    selected = dataset.select(columns=['y', 'x0', 'x1'])
+    flbenchmark.datasets.save_dataset(selected, str(tmp_path / 'no_id'))
+    assert not os.path.exists(str(tmp_path / 'no_id' / '_align.npz'))
+    assert [list(party.records) for party in flbenchmark.datasets.load_dataset(str(tmp_path / 'no_id')).parties] == \
+        [list(party.records) for party in selected.parties]
+
+
+def test_columns_from_pandas():
+    import pandas as pd
+    df = pd.read_csv(io.StringIO('id,y,x0,x1,x2\n0,1,0.5,3000000000,True\n1,0,,-7,False\n2,1,0.1,5,True\n'))
+    # the cell by cell conversion download_convert_fate used before
+    records = [[df.iat[i, j].item() for j in range(df.shape[1])] for i in range(df.shape[0])]
+    party = Party('p', df.columns.tolist(), columns=columns_from_pandas(df))
+    assert [column.dtype.name for column in party.to_columns()] == ['int8', 'int8', 'float64', 'int64', 'bool']
+    assert party.to_json() == Party('p', df.columns.tolist(), records).to_json()
+    party = Party('p', ['x'], columns=columns_from_pandas(pd.DataFrame({'x': ['a', None, 'b']})))
+    assert list(party.records) == [['a'], [None], ['b']]